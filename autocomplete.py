@@ -0,0 +1,131 @@
+import bisect
+import logging
+import re
+import threading
+
+import config
+import instrumentation
+from cache import LRUCache
+from db import get_db_connection, put_db_connection, User
+
+
+# Подсказки тегов и заметок для ссылок при вводе заметки. Для каждого пользователя
+# в памяти процесса строятся отсортированные списки ключей, и префикс ищется в них
+# двоичным поиском. Индекс строится при первом запросе и перестраивается в фоне,
+# когда меняется notes_version пользователя: её увеличивает любое изменение заметок и тегов.
+# До конца перестроения подсказки ищутся в прежнем индексе
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'\w+')
+
+indexes = LRUCache(config.AUTOCOMPLETE_CACHE_USERS, config.AUTOCOMPLETE_CACHE_TTL)
+_builds = {}  # user_id -> поток, строящий индекс
+_build_lock = threading.Lock()
+_builds_total = 0
+
+
+class PrefixIndex:
+    """Префиксный индекс тегов и слов заголовков заметок одного пользователя."""
+
+    def __init__(self, version, tags, notes):
+        self.version = version
+        # Теги: ключ - тег в нижнем регистре
+        tags = sorted(tags, key=lambda tag: tag[0].lower())
+        self.tag_keys = [tag.lower() for tag, _ in tags]
+        self.tags = tags
+        # Заметки: ключ - каждое слово заголовка, так что заметка находится по началу любого слова
+        self.titles = dict(notes)
+        words = sorted({(word, local_id) for local_id, title in notes
+                        for word in _WORD_RE.findall(title.lower())})
+        self.word_keys = [word for word, _ in words]
+        self.word_notes = [local_id for _, local_id in words]
+
+    def _range(self, keys, prefix):
+        start = bisect.bisect_left(keys, prefix)
+        # Префикс с максимальным символом в конце больше любого ключа, начинающегося с префикса
+        end = bisect.bisect_right(keys, prefix + '\U0010ffff', start, min(len(keys), start + config.AUTOCOMPLETE_SCAN))
+        return start, end
+
+    def find_tags(self, query, limit):
+        """Возвращает [(тег, число заметок)], начинающиеся с query, от самых частых."""
+        query = query.strip().lower()
+        if not query:
+            return []
+        start, end = self._range(self.tag_keys, query)
+        return sorted(self.tags[start:end], key=lambda tag: (-tag[1], tag[0]))[:limit]
+
+    def find_notes(self, query, limit):
+        """Возвращает [(local_id, заголовок)] заметок, в заголовке которых есть слова query.
+
+        Последнее слово query может быть недописанным. Новые заметки выводятся первыми.
+        """
+        words = _WORD_RE.findall(query.lower())
+        if not words:
+            return []
+        start, end = self._range(self.word_keys, words[-1])
+        local_ids = set(self.word_notes[start:end])
+        if len(words) > 1:
+            local_ids = {local_id for local_id in local_ids
+                         if all(word in self.titles[local_id].lower() for word in words[:-1])}
+        return [(local_id, self.titles[local_id]) for local_id in sorted(local_ids, reverse=True)[:limit]]
+
+
+def _build(user_id, version):
+    global _builds_total
+    try:
+        conn = get_db_connection(read_only=True)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(r"select tag, note_count from user_tags where user_id = %s and note_count > 0;", (user_id,))
+            tags = cursor.fetchall()
+            cursor.execute(r"select local_id, title from notes where user_id = %s;", (user_id,))
+            notes = cursor.fetchall()
+        finally:
+            cursor.close()
+            put_db_connection(conn)
+
+        indexes.set(str(user_id), PrefixIndex(version, tags, notes))
+    except Exception:
+        logger.exception('Не удалось построить индекс подсказок пользователя %s', user_id)
+    finally:
+        with _build_lock:
+            _builds.pop(user_id, None)
+            _builds_total += 1
+
+
+def _start_build(user_id, version):
+    # Индекс пользователя строится одновременно не больше одного раза в процессе
+    with _build_lock:
+        thread = _builds.get(user_id)
+        if thread is None:
+            thread = _builds[user_id] = threading.Thread(target=_build, args=(user_id, version),
+                                                         name='autocomplete-build', daemon=True)
+            thread.start()
+    return thread
+
+
+def get_index(user_id):
+    stamp = User.get_notes_stamp(user_id)
+    if stamp is None:
+        return None
+    index = indexes.get(str(user_id))
+    if index is None:
+        # Без индекса подсказать нечего: запрос ждёт построения, одновременные запросы -
+        # того же построения
+        _start_build(user_id, stamp.version).join()
+        return indexes.get(str(user_id))
+    if index.version != stamp.version:
+        _start_build(user_id, stamp.version)
+    return index
+
+
+def _metrics():
+    metrics = {f'autocomplete_indexes_{name}': value for name, value in indexes.get_stats().items()}
+    with _build_lock:
+        metrics['autocomplete_builds_total'] = _builds_total
+    return metrics
+
+
+def init_app(app):
+    instrumentation.metrics_sources.append(_metrics)
@@ -0,0 +1,478 @@
+import argparse
+import http.client
+import io
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+from urllib.parse import urlencode, urlparse
+
+# Число SQL-запросов берётся из заголовка Server-Timing, поэтому инструментирование
+# включается до импорта модулей приложения
+os.environ.setdefault('INSTRUMENTATION_ENABLED', '1')
+
+import psycopg2  # noqa: E402
+
+import config  # noqa: E402
+import seed  # noqa: E402
+import tag_query  # noqa: E402
+import vault  # noqa: E402
+from db import get_db_connection, put_db_connection, User, Tag, Note  # noqa: E402
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results')
+
+PERCENTILES = (50, 95, 99)
+
+_server_timing_re = re.compile(r'db;dur=[\d.]+;desc="(\d+) queries"')
+_csrf_re = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, sql_counts, elapsed):
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+    }
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary[f'p{p}_ms'] = round(value * 1000, 3) if value is not None else None
+    summary['sql_statements'] = round(sum(sql_counts) / len(sql_counts), 2) if sql_counts else None
+    return summary
+
+
+def sql_count(server_timing):
+    match = _server_timing_re.search(server_timing or '')
+    return int(match.group(1)) if match else None
+
+
+def build_endpoints(email, rng, count):
+    """Возвращает {название: [пути]} запросов к каждому маршруту для пользователя email."""
+    user_id = User.authenticate_user(email, seed.SEED_PASSWORD).id
+    tags = Tag.get_user_tags(user_id)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(r"select coalesce(max(local_id), 1) from notes where user_id = %s;", (user_id,))
+    max_local_id = cursor.fetchone()[0]
+    cursor.close()
+    put_db_connection(conn)
+
+    return {
+        'notes': ['/notes'] * count,
+        'notes_page': ['/notes?' + urlencode({'after': rng.randint(1, max_local_id)}) for _ in range(count)],
+        'note': [f'/note/{rng.randint(1, max_local_id)}' for _ in range(count)],
+        'graph': [f'/note/{rng.randint(1, max_local_id)}/graph?depth=2' for _ in range(count)],
+        'search': ['/notes?' + urlencode({'q': rng.choice(seed.WORDS)}) for _ in range(count)],
+        'tag_filter': ['/notes?' + urlencode({'tq': tag_query.quote(rng.choice(tags)[0].tag_str)})
+                       for _ in range(count)] if tags else [],
+        'tag_query': ['/notes?' + urlencode({'tq': ' '.join((tag_query.quote(a[0].tag_str), 'OR',
+                                                                tag_query.quote(b[0].tag_str), 'NOT',
+                                                                tag_query.quote(c[0].tag_str)))})
+                      for a, b, c in (rng.sample(tags, 3) for _ in range(count))] if len(tags) >= 3 else [],
+        'tags': ['/tags'] * count,
+        'autocomplete': [rng.choice(('/autocomplete/notes?', '/autocomplete/tags?')) +
+                         urlencode({'q': rng.choice(seed.WORDS)[:rng.randint(1, 3)]}) for _ in range(count)],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_test_client(args):
+    """Замеряет маршруты через тестовый клиент Flask в одном потоке, без сети."""
+    import main
+
+    # У потоковых ответов нет Server-Timing: списки рендерятся целиком, чтобы
+    # число SQL-запросов учитывало и чтение заметок во время рендера шаблона
+    config.STREAM_TEMPLATES = False
+    app = main.create_app()
+    app.config['WTF_CSRF_ENABLED'] = False
+    logging.getLogger('zettelkasten.requests').setLevel(logging.WARNING)
+    client = app.test_client()
+    response = client.post('/login', data={'email': args.email, 'password': seed.SEED_PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f'Не удалось войти как {args.email}')
+
+    rng = random.Random(args.random_seed)
+    endpoints = build_endpoints(args.email, rng, args.requests)
+    results = {}
+    for name, paths in endpoints.items():
+        for path in paths[:args.warmup]:
+            client.get(path, buffered=True)
+        latencies = []
+        sql_counts = []
+        start = time.perf_counter()
+        for path in paths:
+            request_start = time.perf_counter()
+            response = client.get(path, buffered=True)
+            latencies.append(time.perf_counter() - request_start)
+            if response.status_code != 200:
+                raise RuntimeError(f'{path}: HTTP {response.status_code}')
+            count = sql_count(response.headers.get('Server-Timing'))
+            if count is not None:
+                sql_counts.append(count)
+        results[name] = summarize(latencies, sql_counts, time.perf_counter() - start)
+    return results
+
+
+class HttpSession:
+    """Соединение keep-alive с cookie сессии, вошедшее под пользователем email."""
+
+    def __init__(self, url, email):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        self.cookies = {}
+        self.login(email)
+
+    def request(self, method, path, body=None):
+        headers = {'Cookie': '; '.join(f'{k}={v}' for k, v in self.cookies.items())}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        data = response.read()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            name, _, value = header.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value.strip()
+        return response, data
+
+    def login(self, email):
+        _, data = self.request('GET', '/login')
+        match = _csrf_re.search(data.decode('utf-8'))
+        form = {'email': email, 'password': seed.SEED_PASSWORD}
+        if match:
+            form['csrf_token'] = match.group(1)
+        response, _ = self.request('POST', '/login', urlencode(form))
+        if response.status != 302:
+            raise RuntimeError(f'Не удалось войти как {email}')
+
+
+def run_http(args):
+    """Нагружает запущенный сервер args.url параллельно из args.concurrency потоков."""
+    rng = random.Random(args.random_seed)
+    endpoints = build_endpoints(args.email, rng, args.requests)
+    results = {}
+    for name, paths in endpoints.items():
+        sessions = [HttpSession(args.url, args.email) for _ in range(args.concurrency)]
+        lock = threading.Lock()
+        latencies = []
+        sql_counts = []
+        errors = []
+        queue = list(paths)
+
+        def worker(session):
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    path = queue.pop()
+                request_start = time.perf_counter()
+                try:
+                    response, _ = session.request('GET', path)
+                except (OSError, http.client.HTTPException) as e:
+                    session.conn.close()
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                latency = time.perf_counter() - request_start
+                count = sql_count(response.headers.get('Server-Timing'))
+                with lock:
+                    if response.status != 200:
+                        errors.append(f'{path}: HTTP {response.status}')
+                    latencies.append(latency)
+                    if count is not None:
+                        sql_counts.append(count)
+
+        threads = [threading.Thread(target=worker, args=(s,)) for s in sessions]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results[name] = summarize(latencies, sql_counts, time.perf_counter() - start)
+        results[name]['errors'] = len(errors)
+    return results
+
+
+STRESS_TITLE = 'stress'
+
+
+def _stress_vault(prefix, count, rng):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for i in range(count):
+            archive.writestr(f'{prefix}-{i}.md', f'---\ntags: [{STRESS_TITLE}]\n---\n{seed._sentence(rng)}\n')
+    buffer.seek(0)
+    return buffer
+
+
+def stress_add_notes(args):
+    """Создаёт заметки одного пользователя одновременно из нескольких потоков.
+
+    args.concurrency потоков по args.requests раз вызывают Note.add_note, параллельно
+    args.imports потоков импортируют архивы по args.import_notes заметок. Созданные
+    заметки в конце удаляются.
+    """
+    user_id = User.authenticate_user(args.email, seed.SEED_PASSWORD).id
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.concurrency + args.imports)
+    latencies = []
+    local_ids = []
+    errors = []
+    imported = []
+
+    def add_worker(n):
+        rng = random.Random(args.random_seed + n)
+        barrier.wait()
+        for i in range(args.requests):
+            request_start = time.perf_counter()
+            try:
+                note = Note.add_note(user_id, f'{STRESS_TITLE} {n}-{i}', seed._sentence(rng),
+                                     [STRESS_TITLE, rng.choice(seed.TAG_WORDS)])
+            except psycopg2.Error as e:
+                with lock:
+                    errors.append(e)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - request_start)
+                local_ids.append(note.local_id)
+
+    def import_worker(n):
+        archive = _stress_vault(f'{STRESS_TITLE} import {n}', args.import_notes, random.Random(n))
+        barrier.wait()
+        try:
+            result = vault.import_vault(user_id, archive)
+        except psycopg2.Error as e:
+            with lock:
+                errors.append(e)
+            return
+        with lock:
+            imported.append(result.imported)
+
+    threads = [threading.Thread(target=add_worker, args=(n,)) for n in range(args.concurrency)]
+    threads += [threading.Thread(target=import_worker, args=(n,)) for n in range(args.imports)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    query = r"select count(*), count(distinct local_id) from notes " \
+            r"where user_id = %s and title like %s;"
+    cursor.execute(query, (user_id, STRESS_TITLE + ' %'))
+    stored, distinct = cursor.fetchone()
+    cursor.execute(r"delete from notes where user_id = %s and title like %s;", (user_id, STRESS_TITLE + ' %'))
+    conn.commit()
+    cursor.close()
+    put_db_connection(conn)
+
+    summary = summarize(latencies, [], elapsed)
+    summary.update({
+        'errors': len(errors),
+        'unique_violations': sum(isinstance(e, psycopg2.errors.UniqueViolation) for e in errors),
+        'duplicate_local_ids': len(local_ids) - len(set(local_ids)),
+        'imported': sum(imported),
+        'stored': stored,
+        'stored_distinct_local_ids': distinct,
+    })
+    for e in errors[:5]:
+        print(f'{type(e).__name__}: {e}'.strip())
+    return {'add_note': summary}
+
+
+def stream_notes_page(args):
+    """Сравнивает отдачу длинного списка заметок потоком и одним ответом.
+
+    Для каждого режима STREAM_TEMPLATES запрашивает /notes со страницей в args.page_size
+    заметок и замеряет время до первой порции ответа, время до конца ответа
+    и пик выделенной памяти по tracemalloc.
+    """
+    import tracemalloc
+    import main
+
+    config.NOTES_PAGE_SIZE = args.page_size
+    app = main.create_app()
+    app.config['WTF_CSRF_ENABLED'] = False
+    logging.getLogger('zettelkasten.requests').setLevel(logging.WARNING)
+    client = app.test_client()
+    response = client.post('/login', data={'email': args.email, 'password': seed.SEED_PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f'Не удалось войти как {args.email}')
+
+    results = {}
+    for stream in (False, True):
+        config.STREAM_TEMPLATES = stream
+        first_chunk = []
+        latencies = []
+        peaks = []
+        for _ in range(args.requests):
+            tracemalloc.start()
+            request_start = time.perf_counter()
+            response = client.get('/notes', buffered=False)
+            chunks = iter(response.response)
+            next(chunks, None)
+            first_chunk.append(time.perf_counter() - request_start)
+            for _ in chunks:
+                pass
+            response.close()
+            latencies.append(time.perf_counter() - request_start)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            if response.status_code != 200:
+                raise RuntimeError(f'/notes: HTTP {response.status_code}')
+        summary = summarize(latencies, [], sum(latencies))
+        first_chunk.sort()
+        summary['first_chunk_p50_ms'] = round(percentile(first_chunk, 50) * 1000, 2)
+        summary['peak_memory_mb'] = round(max(peaks) / 2 ** 20, 2)
+        results['stream' if stream else 'render'] = summary
+    return results
+
+
+def save_results(mode, args, results):
+    revision = git_revision()
+    report = {
+        'mode': mode,
+        'revision': revision,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'email': args.email,
+        'requests_per_endpoint': args.requests,
+        'concurrency': getattr(args, 'concurrency', 1),
+        'endpoints': results,
+    }
+    path = args.output or os.path.join(RESULTS_DIR, f'{mode}-{revision or "unknown"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def print_results(results):
+    columns = ('requests', 'errors', 'throughput_rps', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'sql_statements')
+    print(f'{"endpoint":<12}' + ''.join(f'{c:>16}' for c in columns))
+    for name, summary in results.items():
+        print(f'{name:<12}' + ''.join(f'{str(summary.get(c)):>16}' for c in columns))
+
+
+def compare(args):
+    """Сравнивает два сохранённых результата: изменение в процентах относительно базового."""
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+    metrics = ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'sql_statements')
+    print(f'{baseline.get("revision")} -> {current.get("revision")}')
+    print(f'{"endpoint":<12}' + ''.join(f'{m:>32}' for m in metrics))
+    for name, summary in current['endpoints'].items():
+        base = baseline['endpoints'].get(name, {})
+        cells = []
+        for metric in metrics:
+            old, new = base.get(metric), summary.get(metric)
+            if old in (None, 0) or new is None:
+                cells.append(f'{str(new):>32}')
+            else:
+                cells.append(f'{f"{old} -> {new} ({(new - old) / old * 100:+.1f}%)":>32}')
+        print(f'{name:<12}' + ''.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочное тестирование маршрутов zettelkasten')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = subparsers.add_parser('seed', help='создать синтетические данные')
+    seed_parser.add_argument('--users', type=int, default=5)
+    seed_parser.add_argument('--notes', type=int, default=2000, help='заметок у каждого пользователя')
+    seed_parser.add_argument('--tags-per-note', type=int, default=3)
+    seed_parser.add_argument('--links-per-note', type=int, default=2)
+    seed_parser.add_argument('--tag-vocabulary', type=int, default=50)
+    seed_parser.add_argument('--reset', action='store_true', help='удалить ранее созданные синтетические данные')
+
+    for name, help_text in (('run', 'замер через тестовый клиент Flask'),
+                            ('load', 'нагрузка запущенного сервера по HTTP')):
+        run_parser = subparsers.add_parser(name, help=help_text)
+        run_parser.add_argument('--email', default=seed.seed_email(1), help='пользователь, от имени которого идут запросы')
+        run_parser.add_argument('--requests', type=int, default=200, help='запросов к каждому маршруту')
+        run_parser.add_argument('--random-seed', type=int, default=0)
+        run_parser.add_argument('--output', help='файл результатов, по умолчанию bench_results/<режим>-<ревизия>.json')
+        if name == 'run':
+            run_parser.add_argument('--warmup', type=int, default=10)
+        else:
+            run_parser.add_argument('--url', default='http://127.0.0.1:80')
+            run_parser.add_argument('--concurrency', type=int, default=16)
+
+    stress_parser = subparsers.add_parser('stress', help='одновременное создание заметок одного пользователя')
+    stress_parser.add_argument('--email', default=seed.seed_email(1))
+    stress_parser.add_argument('--concurrency', type=int, default=8, help='потоков, вызывающих Note.add_note')
+    stress_parser.add_argument('--requests', type=int, default=100, help='заметок от каждого потока')
+    stress_parser.add_argument('--imports', type=int, default=2, help='потоков, одновременно импортирующих архивы')
+    stress_parser.add_argument('--import-notes', type=int, default=500, help='заметок в каждом архиве')
+    stress_parser.add_argument('--random-seed', type=int, default=0)
+    stress_parser.add_argument('--output')
+
+    stream_parser = subparsers.add_parser('stream', help='список заметок потоком и одним ответом')
+    stream_parser.add_argument('--email', default=seed.seed_email(1))
+    stream_parser.add_argument('--page-size', type=int, default=10000, help='заметок на странице /notes')
+    stream_parser.add_argument('--requests', type=int, default=5, help='запросов в каждом режиме')
+    stream_parser.add_argument('--output')
+
+    compare_parser = subparsers.add_parser('compare', help='сравнить два файла результатов')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        if args.reset:
+            seed.reset()
+        user_ids = seed.seed(args.users, args.notes, args.tags_per_note, args.links_per_note, args.tag_vocabulary)
+        print(f'Создано пользователей: {len(user_ids)}, заметок: {len(user_ids) * args.notes}')
+    elif args.command in ('run', 'load'):
+        results = run_test_client(args) if args.command == 'run' else run_http(args)
+        print_results(results)
+        print('Результаты сохранены в ' + save_results(args.command, args, results))
+    elif args.command == 'stress':
+        results = stress_add_notes(args)
+        print_results(results)
+        summary = results['add_note']
+        for key in ('unique_violations', 'duplicate_local_ids', 'imported', 'stored', 'stored_distinct_local_ids'):
+            print(f'{key}: {summary[key]}')
+        print('Результаты сохранены в ' + save_results(args.command, args, results))
+        expected = args.concurrency * args.requests + args.imports * args.import_notes
+        if summary['errors'] or summary['stored'] != expected or summary['stored_distinct_local_ids'] != expected:
+            sys.exit(1)
+    elif args.command == 'stream':
+        results = stream_notes_page(args)
+        print_results(results)
+        for name, summary in results.items():
+            print(f'{name}: first_chunk_p50_ms {summary["first_chunk_p50_ms"]}, '
+                  f'peak_memory_mb {summary["peak_memory_mb"]}')
+        print('Результаты сохранены в ' + save_results(args.command, args, results))
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
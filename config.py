@@ -0,0 +1,115 @@
+import os
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+DB_HOST = os.environ.get('DB_HOST', 'db')
+DB_PORT = _env_int('DB_PORT', 5432)
+DB_NAME = os.environ.get('DB_NAME', 'zettelkasten')
+DB_USER = os.environ.get('DB_USER', 'app')
+DB_PASSWORD = os.environ.get('DB_PASSWORD', '0000')
+
+# Пул соединений с БД
+DB_POOL_MIN_SIZE = _env_int('DB_POOL_MIN_SIZE', 1)
+DB_POOL_MAX_SIZE = _env_int('DB_POOL_MAX_SIZE', 10)
+# Сколько секунд ждать свободное соединение, прежде чем считать пул исчерпанным
+DB_POOL_TIMEOUT = _env_float('DB_POOL_TIMEOUT', 5)
+# Простаивающие дольше этого соединения закрываются (сверх DB_POOL_MIN_SIZE)
+DB_POOL_IDLE_TIMEOUT = _env_float('DB_POOL_IDLE_TIMEOUT', 300)
+# Соединение, простоявшее дольше этого, проверяется запросом перед выдачей
+DB_POOL_HEALTH_CHECK_INTERVAL = _env_float('DB_POOL_HEALTH_CHECK_INTERVAL', 30)
+
+# Реплики БД только для чтения (потоковая репликация с DB_HOST): "host:port,host:port",
+# пусто - без реплик. Читающие запросы GET идут на реплику, изменения - на DB_HOST.
+# У каждой реплики свой пул соединений с настройками DB_POOL_*
+DB_REPLICA_HOSTS = [host.strip() for host in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if host.strip()]
+# Сколько секунд пользователь читает с DB_HOST после изменения своих данных, чтобы
+# увидеть изменения, ещё не дошедшие до реплик. Должно быть больше отставания реплик
+DB_READ_YOUR_WRITES_WINDOW = _env_float('DB_READ_YOUR_WRITES_WINDOW', 5)
+# Недоступная реплика не используется столько секунд, её чтения идут на DB_HOST
+DB_REPLICA_RETRY_INTERVAL = _env_float('DB_REPLICA_RETRY_INTERVAL', 30)
+DB_REPLICA_CONNECT_TIMEOUT = _env_int('DB_REPLICA_CONNECT_TIMEOUT', 2)
+
+# Версия приложения в валидаторах кеша страниц (ETag): пусто - хеш кода и шаблонов.
+# После выкладки с другой версией сохранённые у клиентов копии страниц не подходят
+APP_VERSION = os.environ.get('APP_VERSION', '')
+
+# Число заметок на одной странице списка /notes
+NOTES_PAGE_SIZE = _env_int('NOTES_PAGE_SIZE', 50)
+
+# Страницы списков отдаются по мере рендера шаблона, а заметки читаются
+# из БД порциями по NOTES_STREAM_BATCH_SIZE
+STREAM_TEMPLATES = os.environ.get('STREAM_TEMPLATES', '1') == '1'
+NOTES_STREAM_BATCH_SIZE = _env_int('NOTES_STREAM_BATCH_SIZE', 100)
+
+# Граф заметки /note/<id>/graph: наибольшая глубина обхода, число заметок
+# и число рёбер по общим тегам в ответе
+GRAPH_MAX_DEPTH = _env_int('GRAPH_MAX_DEPTH', 3)
+GRAPH_MAX_NODES = _env_int('GRAPH_MAX_NODES', 200)
+GRAPH_MAX_TAG_EDGES = _env_int('GRAPH_MAX_TAG_EDGES', 1000)
+# Обход графа по общим тегам не переходит по тегам, у которых больше заметок
+GRAPH_MAX_TAG_NOTES = _env_int('GRAPH_MAX_TAG_NOTES', 100)
+
+# Похожие заметки на странице заметки: число заметок, вес похожести по тегам (остальное -
+# по словам заголовка и текста), доля заметок, слова из которой не учитываются,
+# и доля изменённых заметок, после которой модель пользователя строится заново
+RELATED_NOTES_COUNT = _env_int('RELATED_NOTES_COUNT', 5)
+RELATED_TAG_WEIGHT = _env_float('RELATED_TAG_WEIGHT', 0.4)
+RELATED_MAX_DF = _env_float('RELATED_MAX_DF', 0.5)
+RELATED_REBUILD_FRACTION = _env_float('RELATED_REBUILD_FRACTION', 0.2)
+# Модели похожих заметок хранятся в памяти каждого процесса: число пользователей и время жизни
+RELATED_CACHE_USERS = _env_int('RELATED_CACHE_USERS', 100)
+RELATED_CACHE_TTL = _env_float('RELATED_CACHE_TTL', 3600)
+
+# Подсказки тегов и заметок при вводе: число подсказок, наибольшее число просматриваемых
+# ключей индекса на запрос, число пользователей с индексом в памяти процесса и время жизни индекса
+AUTOCOMPLETE_LIMIT = _env_int('AUTOCOMPLETE_LIMIT', 10)
+AUTOCOMPLETE_SCAN = _env_int('AUTOCOMPLETE_SCAN', 2000)
+AUTOCOMPLETE_CACHE_USERS = _env_int('AUTOCOMPLETE_CACHE_USERS', 1000)
+AUTOCOMPLETE_CACHE_TTL = _env_float('AUTOCOMPLETE_CACHE_TTL', 3600)
+
+# Кэш пользователей для flask_login: число записей и время жизни записи в секундах.
+# Кэш свой у каждого воркера и не сбрасывается при изменении users: устаревание
+# записи ограничено только USER_CACHE_TTL
+USER_CACHE_SIZE = _env_int('USER_CACHE_SIZE', 10000)
+USER_CACHE_TTL = _env_float('USER_CACHE_TTL', 60)
+
+# Удаление тегов без заметок в фоновом потоке каждого воркера: период в секундах
+# (0 - не удалять, останется "python manage.py sweep-tags") и размер порции
+TAG_SWEEP_INTERVAL = _env_float('TAG_SWEEP_INTERVAL', 600)
+TAG_SWEEP_BATCH_SIZE = _env_int('TAG_SWEEP_BATCH_SIZE', 1000)
+
+# Фоновые задачи после сохранения заметок: потоков в каждом процессе (0 - не выполнять,
+# останется "python manage.py run-jobs"), период опроса таблицы задач в секундах, число попыток,
+# пауза перед первым повтором (дальше удваивается) и время, после которого задачу
+# незавершившего её процесса берёт другой
+JOB_WORKERS = _env_int('JOB_WORKERS', 2)
+JOB_POLL_INTERVAL = _env_float('JOB_POLL_INTERVAL', 5)
+JOB_MAX_ATTEMPTS = _env_int('JOB_MAX_ATTEMPTS', 5)
+JOB_RETRY_DELAY = _env_float('JOB_RETRY_DELAY', 10)
+JOB_LEASE = _env_float('JOB_LEASE', 300)
+
+# Максимальный размер загружаемого файла (архива для импорта заметок), в байтах
+MAX_UPLOAD_SIZE = _env_int('MAX_UPLOAD_SIZE', 100 * 1024 * 1024)
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# Замер SQL-запросов и рендера markdown на каждый запрос: заголовок Server-Timing,
+# структурированный лог и гистограммы в /metrics. Выключено — курсоры без обёрток
+INSTRUMENTATION_ENABLED = os.environ.get('INSTRUMENTATION_ENABLED', '0') == '1'
+# Адреса и сети, с которых доступен /metrics, через запятую. В docker-compose запросы
+# с хоста приходят с адреса шлюза сети docker, например 172.17.0.1 или 172.16.0.0/12
+METRICS_ALLOWED_ADDRS = [addr.strip() for addr in os.environ.get('METRICS_ALLOWED_ADDRS', '127.0.0.1,::1').split(',')
+                         if addr.strip()]
+
+# Асинхронный слой данных (db_async.py, asyncpg) для читающих маршрутов: независимые
+# запросы страницы выполняются одновременно. Размер отдельного пула asyncpg на процесс
+ASYNC_DB_ENABLED = os.environ.get('ASYNC_DB_ENABLED', '0') == '1'
+ASYNC_DB_POOL_MIN_SIZE = _env_int('ASYNC_DB_POOL_MIN_SIZE', 1)
+ASYNC_DB_POOL_MAX_SIZE = _env_int('ASYNC_DB_POOL_MAX_SIZE', 10)
@@ -1,18 +1,267 @@
+import io
+import logging
+import os
+import random
+import threading
+import time
+from collections import namedtuple
 from datetime import datetime
 
-import psycopg2
+from flask import g, has_app_context, has_request_context, request, session
 from flask_login import UserMixin
 
-
-def get_db_connection():
-    conn = psycopg2.connect(
-        host='db',
-        port=5432,
-        database='zettelkasten',
-        user='app',
-        password='0000'
+import config
+import instrumentation
+from cache import LRUCache
+from db_pool import ConnectionPool
+from links import extract_links
+from tag_query import compile_sql
+from md_extentions import RENDER_VERSION, render_markdown
+
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Пулы реплик из DB_REPLICA_HOSTS и время, до которого недоступная реплика не используется
+_replica_pools = []
+_replica_down_until = []
+_replica_pools_pid = None
+_routing_stats = {'replica_requests': 0, 'pinned_requests': 0, 'replica_fallbacks': 0}
+
+# Пользователи, загружаемые flask_login на каждый запрос
+user_cache = LRUCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+
+# Устанавливается после постановки фоновой задачи: потоки jobs.py ждут его между опросами таблицы
+job_added = threading.Event()
+
+# Метка изменений заметок пользователя; note_dt_edited - время последнего изменения
+# заметки, если метка запрошена для неё, и None, если такой заметки нет
+NotesStamp = namedtuple('NotesStamp', ['version', 'dt_changed', 'note_dt_edited'])
+
+
+def _create_pool(host, port, **conn_kwargs):
+    return ConnectionPool(
+        min_size=config.DB_POOL_MIN_SIZE,
+        max_size=config.DB_POOL_MAX_SIZE,
+        timeout=config.DB_POOL_TIMEOUT,
+        idle_timeout=config.DB_POOL_IDLE_TIMEOUT,
+        health_check_interval=config.DB_POOL_HEALTH_CHECK_INTERVAL,
+        host=host,
+        port=port,
+        database=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD,
+        **conn_kwargs,
+        **instrumentation.connection_kwargs()
     )
-    return conn
+
+
+def get_pool():
+    global _pool, _pool_pid
+    # Соединения нельзя разделять между процессами: после fork пул создаётся заново
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool_pid = os.getpid()
+                _pool = _create_pool(config.DB_HOST, config.DB_PORT)
+    return _pool
+
+
+def get_replica_pools():
+    global _replica_pools, _replica_down_until, _replica_pools_pid
+    if _replica_pools_pid != os.getpid():
+        with _pool_lock:
+            if _replica_pools_pid != os.getpid():
+                pools = []
+                for address in config.DB_REPLICA_HOSTS:
+                    host, _, port = address.partition(':')
+                    pools.append(_create_pool(host, int(port or config.DB_PORT),
+                                              connect_timeout=config.DB_REPLICA_CONNECT_TIMEOUT))
+                _replica_pools = pools
+                _replica_down_until = [0.0] * len(pools)
+                _replica_pools_pid = os.getpid()
+    return _replica_pools
+
+
+def set_pool(pool):
+    # Подменяет пул процесса, например пулом с другим cursor_factory
+    global _pool, _pool_pid
+    with _pool_lock:
+        _pool = pool
+        _pool_pid = os.getpid()
+
+
+def reset_pool():
+    # Вызывается в дочернем процессе после fork: унаследованные соединения не закрываем,
+    # так как закрытие оборвало бы их и в родительском процессе
+    global _pool, _pool_pid, _replica_pools, _replica_pools_pid
+    with _pool_lock:
+        _pool = None
+        _pool_pid = None
+        _replica_pools = []
+        _replica_pools_pid = None
+
+
+def close_pool():
+    global _pool, _pool_pid, _replica_pools, _replica_pools_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        if _replica_pools_pid == os.getpid():
+            for pool in _replica_pools:
+                pool.closeall()
+        _pool = None
+        _pool_pid = None
+        _replica_pools = []
+        _replica_pools_pid = None
+
+
+def pin_primary():
+    """Направляет чтения текущего пользователя на DB_HOST на DB_READ_YOUR_WRITES_WINDOW секунд.
+
+    Вызывается транзакциями, изменяющими данные пользователя. Срок хранится в сессии,
+    поэтому действует во всех процессах.
+    """
+    if config.DB_REPLICA_HOSTS and has_request_context():
+        session['db_primary_until'] = time.time() + config.DB_READ_YOUR_WRITES_WINDOW
+        # Остальные чтения этого запроса тоже идут на DB_HOST
+        g.db_primary_pinned = True
+
+
+def _reads_from_replica():
+    # Реплики используются только в запросах Flask: соединение запроса возвращает в пул
+    # close_db_connection. Запросы, изменяющие данные, читают с DB_HOST, чтобы сравнивать
+    # изменения с актуальными строками
+    if not config.DB_REPLICA_HOSTS or not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return False
+    if session.get('db_primary_until', 0) > time.time():
+        with _pool_lock:
+            _routing_stats['pinned_requests'] += 1
+        return False
+    return True
+
+
+def _get_replica_connection():
+    """Возвращает (пул, соединение) случайной доступной реплики или (None, None)."""
+    pools = get_replica_pools()
+    indexes = list(range(len(pools)))
+    random.shuffle(indexes)
+    for i in indexes:
+        if _replica_down_until[i] > time.monotonic():
+            continue
+        try:
+            conn = pools[i].getconn()
+        except Exception:
+            # Чтения уходят на DB_HOST, пока реплика недоступна, а не ждут соединения с ней
+            # в каждом запросе
+            logger.warning('Реплика %s недоступна', config.DB_REPLICA_HOSTS[i], exc_info=True)
+            _replica_down_until[i] = time.monotonic() + config.DB_REPLICA_RETRY_INTERVAL
+            continue
+        with _pool_lock:
+            _routing_stats['replica_requests'] += 1
+        return pools[i], conn
+    with _pool_lock:
+        _routing_stats['replica_fallbacks'] += 1
+    return None, None
+
+
+def get_db_connection(read_only=False):
+    # В рамках запроса Flask все обращения к БД используют одно соединение из пула,
+    # которое возвращается в пул в close_db_connection. read_only - соединение только
+    # для чтения: в запросе GET оно берётся с реплики, если они настроены
+    if has_app_context():
+        if read_only and not g.get('db_primary_pinned'):
+            # Реплика выбирается один раз на запрос; None - запрос читает с DB_HOST
+            if 'db_read_conn' not in g:
+                g.db_read_pool, g.db_read_conn = _get_replica_connection() if _reads_from_replica() else (None, None)
+            if g.db_read_conn is not None:
+                return g.db_read_conn
+        if 'db_conn' not in g:
+            g.db_conn = get_pool().getconn()
+        return g.db_conn
+    return get_pool().getconn()
+
+
+def put_db_connection(conn):
+    if has_app_context() and (g.get('db_conn') is conn or g.get('db_read_conn') is conn):
+        return
+    get_pool().putconn(conn)
+
+
+def close_db_connection(e=None):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_pool().putconn(conn)
+    read_conn = g.pop('db_read_conn', None)
+    read_pool = g.pop('db_read_pool', None)
+    if read_conn is not None:
+        read_pool.putconn(read_conn)
+
+
+def _identity_map():
+    # Карта идентичности запроса Flask: (класс, ключ) -> объект, уже прочитанный в этом запросе.
+    # Повторное чтение той же строки возвращает тот же объект без запроса к БД, а методы,
+    # изменяющие строку, удаляют её объект из карты. Вне запроса объекты не запоминаются
+    if not has_app_context():
+        return None
+    if 'identity_map' not in g:
+        g.identity_map = {}
+    return g.identity_map
+
+
+def _identity_get(key):
+    identity_map = _identity_map()
+    return None if identity_map is None else identity_map.get(key)
+
+
+def _identity_add(key, obj):
+    identity_map = _identity_map()
+    if identity_map is not None and obj is not None:
+        identity_map[key] = obj
+    return obj
+
+
+def _identity_discard(key):
+    identity_map = _identity_map()
+    if identity_map is not None:
+        identity_map.pop(key, None)
+
+
+def _copy_value(value):
+    # В формате csv пустое значение без кавычек - NULL, а "" - пустая строка
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)):
+        return str(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def copy_rows(cursor, table, columns, rows):
+    # Массовая загрузка строк одной командой COPY вместо отдельных insert
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(','.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"copy {table} ({', '.join(columns)}) from stdin with (format csv)", buffer)
+
+
+def _metrics():
+    metrics = {f'db_pool_{name}': value for name, value in get_pool().get_stats().items()}
+    for i, pool in enumerate(get_replica_pools()):
+        metrics.update({f'db_replica{i}_pool_{name}': value for name, value in pool.get_stats().items()})
+    with _pool_lock:
+        metrics.update({f'db_{name}_total': value for name, value in _routing_stats.items()})
+    metrics.update({f'user_cache_{name}': value for name, value in user_cache.get_stats().items()})
+    return metrics
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db_connection)
+    instrumentation.metrics_sources.append(_metrics)
 
 
 class User(UserMixin):
@@ -38,10 +287,10 @@ class User(UserMixin):
         if result is None:
             user = None
         else:
-            user = User(result[0], result[1], result[2], result[3])
+            user = _identity_add((User, result[0]), User(result[0], result[1], result[2], result[3]))
 
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
         return user
 
@@ -59,12 +308,13 @@ class User(UserMixin):
             result = True
 
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
         return result
 
     @staticmethod
     def add_user(email, password):
+        pin_primary()
         conn = get_db_connection()
         cursor = conn.cursor()
 
@@ -77,13 +327,17 @@ class User(UserMixin):
 
         conn.commit()
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
-        return User(user_id, email, password_hash, dt_added)
+        return _identity_add((User, user_id), User(user_id, email, password_hash, dt_added))
 
     @staticmethod
     def get_user(user_id):
-        conn = get_db_connection()
+        user = _identity_get((User, int(user_id)))
+        if user is not None:
+            return user
+
+        conn = get_db_connection(read_only=True)
         cursor = conn.cursor()
 
         query = r"select id, email, password_hash, dt_added from users where id = %s;"
@@ -92,15 +346,75 @@ class User(UserMixin):
         if result is None:
             user = None
         else:
-            user = User(result[0], result[1], result[2], result[3])
+            user = _identity_add((User, result[0]), User(result[0], result[1], result[2], result[3]))
 
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
         return user
 
+    @staticmethod
+    def get_cached_user(user_id):
+        # flask_login передаёт id из сессии строкой
+        user = _identity_get((User, int(user_id)))
+        if user is not None:
+            return user
+        key = str(user_id)
+        user = user_cache.get(key)
+        if user is None:
+            user = User.get_user(user_id)
+            if user is not None:
+                user_cache.set(key, user)
+        return _identity_add((User, int(user_id)), user)
+
+    @staticmethod
+    def get_notes_stamp(user_id, note_local_id=None):
+        conn = get_db_connection(read_only=True)
+        cursor = conn.cursor()
+
+        query = r"select notes_version, dt_notes_changed, coalesce(notes.dt_edited, notes.dt_added) " \
+                r"from users " \
+                r"left join notes on notes.user_id = users.id and notes.local_id = %s " \
+                r"where users.id = %s;"
+        cursor.execute(query, (note_local_id, user_id))
+        result = cursor.fetchone()
+        stamp = None if result is None else NotesStamp(result[0], result[1], result[2])
+
+        cursor.close()
+        put_db_connection(conn)
+
+        return stamp
+
+    @staticmethod
+    def bump_notes_version(user_id, conn_curs):
+        # Вызывается первым в транзакции, меняющей заметки пользователя: блокировка строки
+        # пользователя упорядочивает его одновременные изменения. Метки нет в User,
+        # поэтому кеш пользователей сбрасывать не нужно
+        pin_primary()
+        conn, cursor = conn_curs
+        query = r"update users set notes_version = notes_version + 1, dt_notes_changed = now() " \
+                r"where id = %s;"
+        cursor.execute(query, (user_id,))
+
+    @staticmethod
+    def allocate_note_local_ids(user_id, count, conn_curs):
+        """Выделяет count подряд идущих local_id для новых заметок, возвращает первый.
+
+        Заменяет bump_notes_version в транзакции, создающей заметки.
+        """
+        pin_primary()
+        conn, cursor = conn_curs
+        query = r"update users set last_note_local_id = last_note_local_id + %s, " \
+                r"notes_version = notes_version + 1, dt_notes_changed = now() " \
+                r"where id = %s " \
+                r"returning last_note_local_id;"
+        cursor.execute(query, (count, user_id))
+        return cursor.fetchone()[0] - count + 1
+
 
 class Tag:
+    __slots__ = ('id', 'user_id', 'tag_str')
+
     def __init__(self, tag_id, user_id, tag_str):
         self.id = tag_id
         self.user_id = user_id
@@ -109,102 +423,102 @@ class Tag:
     def __repr__(self):
         return f'<Tag {self.id}>'
 
+    # id тега уникален среди всех пользователей, поэтому сравнения по нему достаточно
     def __hash__(self):
-        return hash((self.id, self.user_id, self.tag_str))
+        return hash(self.id)
 
     def __eq__(self, other):
-        return self.__hash__() == other.__hash__()
+        if not isinstance(other, Tag):
+            return NotImplemented
+        return self.id == other.id
 
     @staticmethod
-    def _get_tag_id(user_id, tag_str, conn_curs=None):
-        if conn_curs is None:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-        else:
-            conn, cursor = conn_curs
-
-        query = r"select id from user_tags " \
-                r"where user_id = %s and tag = %s;"
-        cursor.execute(query, (user_id, tag_str))
-        result = cursor.fetchone()
-        if result is None:
-            tag_id = None
-        else:
-            tag_id = result[0]
-
-        if conn_curs is None:
-            cursor.close()
-            conn.close()
-
-        return tag_id
+    def _loader():
+        """Возвращает функцию (id, user_id, tag) -> Tag, берущую прочитанные в запросе теги из карты."""
+        identity_map = _identity_map()
+        if identity_map is None:
+            return Tag
+
+        # Строка тега не меняется, поэтому объект из карты годится до конца запроса.
+        # Карта читается из g один раз на вызов: списки заметок загружают тысячи тегов
+        def load(tag_id, user_id, tag_str):
+            tag = identity_map.get((Tag, tag_id))
+            if tag is None:
+                tag = identity_map[(Tag, tag_id)] = Tag(tag_id, user_id, tag_str)
+            return tag
+
+        return load
 
     @staticmethod
-    def _add_user_tag(user_id, tag_str, conn_curs=None):
-        if conn_curs is None:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-        else:
-            conn, cursor = conn_curs
-
-        query = r"insert into user_tags (user_id, tag) " \
-                r"values (%s, %s) " \
-                r"returning id;"
-        cursor.execute(query, (user_id, tag_str))
-        tag_id = cursor.fetchone()[0]
+    def lock_tags(user_id, tags_str, conn_curs):
+        """Блокирует строки тегов пользователя до конца транзакции, создавая недостающие.
 
-        if conn_curs is None:
-            conn.commit()
-            cursor.close()
-            conn.close()
+        Возвращает [(id, тег)].
+        """
+        conn, cursor = conn_curs
 
-        return tag_id
+        # Сортировка задаёт одинаковый порядок блокировки строк user_tags
+        # для параллельных сохранений и исключает взаимоблокировки.
+        # do update вместо do nothing, чтобы returning вернул id и уже существующих тегов.
+        # Параллельное создание того же тега дождётся конца транзакции и получит тот же id
+        query = r"insert into user_tags (user_id, tag) " \
+                r"select %s, unnest(%s::varchar[]) " \
+                r"on conflict (user_id, tag) do update set tag = excluded.tag " \
+                r"returning id, tag;"
+        cursor.execute(query, (user_id, sorted(set(tags_str))))
+        return cursor.fetchall()
 
     @staticmethod
-    def add_tag(user_id, note_id, tag_str, conn_curs=None):
+    def add_tags(user_id, note_id, tags_str, conn_curs=None):
         if conn_curs is None:
             conn = get_db_connection()
             cursor = conn.cursor()
         else:
             conn, cursor = conn_curs
 
-        tag_id = Tag._get_tag_id(user_id, tag_str, conn_curs=(conn, cursor))
-        if tag_id is None:
-            tag_id = Tag._add_user_tag(user_id, tag_str, conn_curs=(conn, cursor))
+        tags = set()
+        if len(tags_str) > 0:
+            result = Tag.lock_tags(user_id, tags_str, (conn, cursor))
+
+            query = r"insert into note_tags (tag_id, note_id) " \
+                    r"select unnest(%s::int[]), %s;"
+            cursor.execute(query, ([row[0] for row in result], note_id))
 
-        query = r"insert into note_tags (tag_id, note_id) " \
-                r"values (%s, %s);"
-        cursor.execute(query, (tag_id, note_id))
+            load = Tag._loader()
+            for row in result:
+                tags.add(load(row[0], user_id, row[1]))
 
         if conn_curs is None:
             conn.commit()
             cursor.close()
-            conn.close()
+            put_db_connection(conn)
 
-        return Tag(tag_id, user_id, tag_str)
+        return tags
 
     @staticmethod
-    def delete_tag(tag_id, note_id, conn_curs=None):
+    def delete_tags(tag_ids, note_id, conn_curs=None):
         if conn_curs is None:
             conn = get_db_connection()
             cursor = conn.cursor()
         else:
             conn, cursor = conn_curs
 
-        query = r"delete from note_tags " \
-                r"where tag_id = %s and note_id = %s;"
-        cursor.execute(query, (tag_id, note_id))
+        if len(tag_ids) > 0:
+            query = r"delete from note_tags " \
+                    r"where note_id = %s and tag_id = any(%s);"
+            cursor.execute(query, (note_id, list(tag_ids)))
 
-        # TODO: удалить тег из user_tags, если больше нигде не используется
+        # Теги, оставшиеся без заметок, удаляет Tag.delete_unused_tags
 
         if conn_curs is None:
             conn.commit()
             cursor.close()
-            conn.close()
+            put_db_connection(conn)
 
     @staticmethod
     def get_note_tags(note_id, conn_curs=None):
         if conn_curs is None:
-            conn = get_db_connection()
+            conn = get_db_connection(read_only=True)
             cursor = conn.cursor()
         else:
             conn, cursor = conn_curs
@@ -214,41 +528,103 @@ class Tag:
                 r"where note_id = %s;"
         cursor.execute(query, (note_id,))
         result = cursor.fetchall()
+        load = Tag._loader()
         tags = set()
         for row in result:
-            tags.add(Tag(row[0], row[1], row[2]))
+            tags.add(load(row[0], row[1], row[2]))
 
         if conn_curs is None:
             cursor.close()
-            conn.close()
+            put_db_connection(conn)
 
         return tags
 
+    @staticmethod
+    def get_notes_tags(note_ids, conn_curs=None):
+        if conn_curs is None:
+            conn = get_db_connection(read_only=True)
+            cursor = conn.cursor()
+        else:
+            conn, cursor = conn_curs
+
+        notes_tags = {note_id: set() for note_id in note_ids}
+        if len(notes_tags) > 0:
+            query = r"select note_id, tag_id, user_id, tag from note_tags " \
+                    r"left join user_tags on note_tags.tag_id = user_tags.id " \
+                    r"where note_id = any(%s);"
+            cursor.execute(query, (list(notes_tags),))
+            load = Tag._loader()
+            for row in cursor.fetchall():
+                notes_tags[row[0]].add(load(row[1], row[2], row[3]))
+
+        if conn_curs is None:
+            cursor.close()
+            put_db_connection(conn)
+
+        return notes_tags
+
     @staticmethod
     def get_user_tags(user_id):
-        conn = get_db_connection()
+        conn = get_db_connection(read_only=True)
         cursor = conn.cursor()
 
-        query = r"select tag_id, user_id, tag, count(tag_id) count " \
+        # note_count поддерживается триггерами на note_tags (миграция 0007)
+        query = r"select id, user_id, tag, note_count " \
                 r"from user_tags " \
-                r"left join note_tags on note_tags.tag_id = user_tags.id " \
-                r"where user_id = %s and tag_id is not null " \
-                r"group by tag_id, user_id, tag " \
-                r"order by count desc, tag;"
+                r"where user_id = %s and note_count > 0 " \
+                r"order by note_count desc, tag;"
         cursor.execute(query, (user_id,))
         result = cursor.fetchall()
+        load = Tag._loader()
         tags = []
         for row in result:
-            tags.append((Tag(row[0], row[1], row[2]), row[3]))
+            tags.append((load(row[0], row[1], row[2]), row[3]))
 
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
         return tags
 
+    @staticmethod
+    def delete_unused_tags(batch_size):
+        """Удаляет теги без заметок порциями по batch_size, каждую в своей транзакции.
+
+        Возвращает число удалённых тегов.
+        """
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            # Теги, заблокированные транзакцией, которая как раз добавляет их к заметке,
+            # пропускаются. Если же тег удаляется первым, add_tags дождётся удаления
+            # и on conflict создаст тег заново
+            query = r"delete from user_tags " \
+                    r"where id in (" \
+                    r"select id from user_tags " \
+                    r"where note_count = 0 " \
+                    r"order by id " \
+                    r"limit %s " \
+                    r"for update skip locked);"
+            deleted = 0
+            while True:
+                cursor.execute(query, (batch_size,))
+                conn.commit()
+                deleted += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    break
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            put_db_connection(conn)
+
+        return deleted
+
 
 class Note:
-    def __init__(self, note_id, user_id, local_id, title, text, dt_added, dt_edited, tags):
+    __slots__ = ('id', 'user_id', 'local_id', 'title', 'text', 'dt_added', 'dt_edited', 'tags', 'html')
+
+    def __init__(self, note_id, user_id, local_id, title, text, dt_added, dt_edited, tags, html=None):
         self.id = note_id
         self.user_id = user_id
         self.local_id = local_id
@@ -257,36 +633,53 @@ class Note:
         self.dt_added = dt_added
         self.dt_edited = dt_edited
         self.tags = tags
+        self.html = html
 
     def __repr__(self):
         return f'<Note {self.id}>'
 
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        if not isinstance(other, Note):
+            return NotImplemented
+        return self.id == other.id
+
     @property
     def sorted_tags(self):
         return sorted(list(self.tags), key=lambda x: x.tag_str)
 
     @staticmethod
     def add_note(user_id, title, text, tags_str):
+        pin_primary()
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        query = r"insert into notes (user_id, local_id, title, text, dt_added) " \
-                r"values (%s, " \
-                r"(select coalesce(max(local_id),0) from notes where user_id = %s)+1, " \
-                r"%s, %s, %s) " \
+        # local_id выделяется из счётчика пользователя в том же запросе, что и вставка:
+        # одновременные сохранения ждут блокировку строки пользователя, а не нарушают
+        # note_constrain. Метка изменений заметок обновляется тем же update
+        query = r"with counter as (" \
+                r"update users set last_note_local_id = last_note_local_id + 1, " \
+                r"notes_version = notes_version + 1, dt_notes_changed = now() " \
+                r"where id = %s " \
+                r"returning last_note_local_id) " \
+                r"insert into notes (user_id, local_id, title, text, dt_added) " \
+                r"select %s, last_note_local_id, %s, %s, %s from counter " \
                 r"returning id, local_id;"
         dt_added = datetime.now()
         cursor.execute(query, (user_id, user_id, title, text, dt_added))
         note_id, note_local_id = cursor.fetchone()
 
-        tags = set()
-        for tag_str in tags_str:
-            tag = Tag.add_tag(user_id, note_id, tag_str, (conn, cursor))
-            tags.add(tag)
+        tags = Tag.add_tags(user_id, note_id, tags_str, (conn, cursor))
+
+        # HTML и ссылки заметки заполняет фоновая задача, до неё get_note рендерит текст сам
+        Job.enqueue(Job.NOTE_DERIVED, note_id, (conn, cursor))
 
         conn.commit()
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
+        job_added.set()
 
         return Note(note_id, user_id, note_local_id, title, text, dt_added, None, tags)
 
@@ -298,8 +691,12 @@ class Note:
             query_set_part += r'title = %s, '
             set_values.append(new_title)
         if note.text != new_text:
-            query_set_part += r'text = %s, '
+            # Прежний HTML не соответствует тексту, новый отрендерит фоновая задача
+            query_set_part += r'text = %s, html = null, html_version = null, '
             set_values.append(new_text)
+            html = None
+        else:
+            html = note.html
 
         tags_updated = sorted([t.tag_str for t in note.tags]) != sorted(new_tags_str_list)
 
@@ -311,12 +708,17 @@ class Note:
         conn = get_db_connection()
         cursor = conn.cursor()
 
+        User.bump_notes_version(note.user_id, (conn, cursor))
+
         query = r"update notes set " + query_set_part + \
                 r"dt_edited = %s where id = %s;"
         set_values.append(dt_edited)
         set_values.append(note.id)
         cursor.execute(query, set_values)
 
+        if note.text != new_text:
+            Job.enqueue(Job.NOTE_DERIVED, note.id, (conn, cursor))
+
         if tags_updated:
             curr_tags_str = {t.tag_str for t in note.tags}
             new_tags_str = set(new_tags_str_list)
@@ -324,22 +726,32 @@ class Note:
             tags_to_delete = [t for t in note.tags if t.tag_str in tags_str_to_delete]
             tags_str_to_add = new_tags_str.difference(curr_tags_str)
 
-            if len(tags_str_to_delete) > 0:
-                for tag_to_delete in tags_to_delete:
-                    Tag.delete_tag(tag_to_delete.id, note.id, (conn, cursor))
-                    note.tags.remove(tag_to_delete)
+            # Удаление из note_tags блокирует строку тега в триггере, а добавление - в запросе,
+            # и порядок этих блокировок у двух правок, меняющих теги местами, разный.
+            # Поэтому все затронутые теги сначала блокируются одним запросом в порядке имён
+            if len(tags_to_delete) > 0 or len(tags_str_to_add) > 0:
+                Tag.lock_tags(note.user_id, tags_str_to_delete | tags_str_to_add, (conn, cursor))
+
+            if len(tags_to_delete) > 0:
+                Tag.delete_tags([t.id for t in tags_to_delete], note.id, (conn, cursor))
+                note.tags.difference_update(tags_to_delete)
 
             if len(tags_str_to_add) > 0:
-                for tags_str_to_add in tags_str_to_add:
-                    tag = Tag.add_tag(note.user_id, note.id, tags_str_to_add, (conn, cursor))
-                    note.tags.add(tag)
+                tags = Tag.add_tags(note.user_id, note.id, tags_str_to_add, (conn, cursor))
+                note.tags.update(tags)
 
         conn.commit()
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
+        if note.text != new_text:
+            job_added.set()
+        # Прочитанная заметка в карте идентичности больше не соответствует строке,
+        # а возвращаемую заметку с html = None не показать без рендера
+        _identity_discard((Note, note.user_id, note.local_id))
 
         note.title = new_title
         note.text = new_text
+        note.html = html
         note.dt_edited = dt_edited
 
         return note
@@ -349,20 +761,30 @@ class Note:
         conn = get_db_connection()
         cursor = conn.cursor()
 
+        cursor.execute(r"select user_id, local_id from notes where id = %s;", (note_id,))
+        result = cursor.fetchone()
+        if result is not None:
+            User.bump_notes_version(result[0], (conn, cursor))
+            _identity_discard((Note, result[0], result[1]))
+
         query = r"delete from notes " \
                 r"where id = %s;"
         cursor.execute(query, (note_id,))
 
         conn.commit()
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
     @staticmethod
     def get_note(user_id, note_local_id):
-        conn = get_db_connection()
+        note = _identity_get((Note, user_id, note_local_id))
+        if note is not None:
+            return note
+
+        conn = get_db_connection(read_only=True)
         cursor = conn.cursor()
 
-        query = r"select id, user_id, local_id, title, text, dt_added, dt_edited " \
+        query = r"select id, user_id, local_id, title, text, dt_added, dt_edited, html, html_version " \
                 r"from notes " \
                 r"where user_id = %s and local_id = %s;"
         cursor.execute(query, (user_id, note_local_id))
@@ -372,43 +794,114 @@ class Note:
             note = None
         else:
             tags = Tag.get_note_tags(result[0], conn_curs=(conn, cursor))
-            note = Note(result[0], result[1], result[2], result[3], result[4], result[5], result[6], tags)
+            html = result[7]
+            if html is None or result[8] != RENDER_VERSION:
+                # Заметка ещё не перерендерена после смены версии рендера
+                html = render_markdown(result[4])
+            note = Note(result[0], result[1], result[2], result[3], result[4], result[5], result[6], tags, html)
+            _identity_add((Note, user_id, note_local_id), note)
 
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
         return note
 
     @staticmethod
-    def get_user_notes(user_id):
-        conn = get_db_connection()
+    def _summary_notes(rows, conn_curs):
+        # Заметки для списков: без текста, строки вида (id, user_id, local_id, title, dt_added, dt_edited)
+        notes_tags = Tag.get_notes_tags([row[0] for row in rows], conn_curs=conn_curs)
+        notes = []
+        for row in rows:
+            note = Note(row[0], row[1], row[2], row[3], None, row[4], row[5], notes_tags[row[0]])
+            notes.append(note)
+        return notes
+
+    @staticmethod
+    def _stream_summary_notes(query, params):
+        # Строки списка читаются серверным курсором порциями, теги - для каждой порции,
+        # поэтому страница начинает выводиться до чтения последней заметки
+        conn = get_db_connection(read_only=True)
         cursor = conn.cursor()
+        read_cursor = conn.cursor(name='summary_notes')
+        try:
+            read_cursor.execute(query, params)
+            while True:
+                rows = read_cursor.fetchmany(config.NOTES_STREAM_BATCH_SIZE)
+                if len(rows) == 0:
+                    break
+                yield from Note._summary_notes(rows, (conn, cursor))
+        finally:
+            read_cursor.close()
+            cursor.close()
+            put_db_connection(conn)
 
-        query = r"select id, user_id, local_id, title, text, dt_added, dt_edited " \
+    @staticmethod
+    def get_user_notes(user_id, after_local_id=0, page_size=None):
+        query = r"select id, user_id, local_id, title, dt_added, dt_edited " \
                 r"from notes " \
-                r"where user_id = %s " \
-                r"order by local_id;"
-        cursor.execute(query, (user_id,))
-        result = cursor.fetchall()
-        notes = []
-        for row in result:
-            tags = Tag.get_note_tags(row[0], conn_curs=(conn, cursor))
-            note = Note(row[0], row[1], row[2], row[3], row[4], row[5], row[6], tags)
-            notes.append(note)
+                r"where user_id = %s and local_id > %s " \
+                r"order by local_id " \
+                r"limit %s;"
+        limit = page_size + 1 if page_size is not None else None
+        return NotesPage(Note._stream_summary_notes(query, (user_id, after_local_id, limit)), page_size)
 
-        cursor.close()
-        conn.close()
+    @staticmethod
+    def _set_links(user_id, note_id, text, conn_curs):
+        conn, cursor = conn_curs
+
+        targets = sorted(extract_links(text))
+        query = r"delete from note_links " \
+                r"where source_id = %s and target_local_id <> all(%s);"
+        cursor.execute(query, (note_id, targets))
+        if len(targets) > 0:
+            query = r"insert into note_links (source_id, user_id, target_local_id) " \
+                    r"select %s, %s, unnest(%s) " \
+                    r"on conflict do nothing;"
+            cursor.execute(query, (note_id, user_id, targets))
 
-        return notes
+    @staticmethod
+    def update_derived(note_id):
+        """Рендерит HTML заметки и обновляет её ссылки. Выполняется фоновой задачей."""
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(r"select user_id, local_id, text from notes where id = %s;", (note_id,))
+            result = cursor.fetchone()
+            if result is not None:
+                user_id, local_id, text = result
+                html = render_markdown(text)
+                cursor.execute(r"select target_local_id from note_links where source_id = %s;", (note_id,))
+                if {row[0] for row in cursor.fetchall()} != extract_links(text):
+                    # Ссылки видны на страницах заметок и в графе, сохранённые у клиентов копии
+                    # которых проверяются по метке изменений заметок. Как и при сохранении,
+                    # строка пользователя блокируется раньше строки заметки
+                    User.bump_notes_version(user_id, (conn, cursor))
+                # Если текст успели изменить, результат устарел: изменение поставило задачу заново
+                query = r"update notes set html = %s, html_version = %s " \
+                        r"where id = %s and text is not distinct from %s;"
+                cursor.execute(query, (html, RENDER_VERSION, note_id, text))
+                if cursor.rowcount > 0:
+                    Note._set_links(user_id, note_id, text, (conn, cursor))
+                    conn.commit()
+                else:
+                    conn.rollback()
+                _identity_discard((Note, user_id, local_id))
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            put_db_connection(conn)
 
     @staticmethod
     def get_notes_linked_to(user_id, local_note_id):
-        conn = get_db_connection()
+        conn = get_db_connection(read_only=True)
         cursor = conn.cursor()
 
-        query = r"select id, user_id, local_id, title " \
-                r"from notes " \
-                r"where user_id = %s and text like '%%[%%](%s)%%' " \
+        query = r"select notes.id, notes.user_id, local_id, title " \
+                r"from note_links " \
+                r"join notes on notes.id = note_links.source_id " \
+                r"where note_links.user_id = %s and target_local_id = %s " \
                 r"order by local_id;"
         cursor.execute(query, (user_id, local_note_id))
         result = cursor.fetchall()
@@ -418,52 +911,210 @@ class Note:
             notes.append(note)
 
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
         return notes
 
     @staticmethod
-    def search_notes(user_id, search_query):
-        conn = get_db_connection()
+    def get_notes_linked_from(note_id):
+        conn = get_db_connection(read_only=True)
         cursor = conn.cursor()
 
-        query = r"select id, user_id, local_id, title, text, dt_added, dt_edited " \
-                r"from notes " \
-                r"where user_id = %s and (text ilike %s or title ilike %s) " \
+        query = r"select notes.id, notes.user_id, local_id, title " \
+                r"from note_links " \
+                r"join notes on notes.user_id = note_links.user_id " \
+                r"and notes.local_id = note_links.target_local_id " \
+                r"where source_id = %s " \
                 r"order by local_id;"
-        search_insert = '%' + search_query + '%'
-        cursor.execute(query, (user_id, search_insert, search_insert))
+        cursor.execute(query, (note_id,))
         result = cursor.fetchall()
         notes = []
         for row in result:
-            tags = Tag.get_note_tags(row[0], conn_curs=(conn, cursor))
-            note = Note(row[0], row[1], row[2], row[3], row[4], row[5], row[6], tags)
+            note = Note(row[0], row[1], row[2], row[3], None, None, None, set())
             notes.append(note)
 
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
         return notes
 
     @staticmethod
-    def get_notes_with_tag(tag_id):
+    def get_notes_with_tag(user_id, tag_id, after_local_id=0, page_size=None):
+        query = r"select notes.id, notes.user_id, local_id, title, dt_added, dt_edited " \
+                r"from notes " \
+                r"join note_tags on notes.id = note_tags.note_id " \
+                r"where notes.user_id = %s and tag_id = %s and local_id > %s " \
+                r"order by local_id " \
+                r"limit %s;"
+        limit = page_size + 1 if page_size is not None else None
+        return NotesPage(Note._stream_summary_notes(query, (user_id, tag_id, after_local_id, limit)), page_size)
+
+    @staticmethod
+    def get_notes_by_tag_query(user_id, expression, after_local_id=0, page_size=None):
+        """Заметки, теги которых удовлетворяют выражению tag_query.parse, по возрастанию local_id."""
+        condition, params = compile_sql(expression, user_id, lambda: r"%s")
+        query = r"select id, user_id, local_id, title, dt_added, dt_edited " \
+                r"from notes " \
+                r"where user_id = %s and local_id > %s and " + condition + r" " \
+                r"order by local_id " \
+                r"limit %s;"
+        limit = page_size + 1 if page_size is not None else None
+        return NotesPage(Note._stream_summary_notes(query, [user_id, after_local_id] + params + [limit]), page_size)
+
+
+class Job:
+    """Задачи фоновой очереди jobs.py в таблице jobs."""
+
+    # HTML и ссылки заметки после её создания или изменения текста
+    NOTE_DERIVED = 'note_derived'
+
+    def __init__(self, job_id, kind, note_id, generation, attempts):
+        self.id = job_id
+        self.kind = kind
+        self.note_id = note_id
+        self.generation = generation
+        self.attempts = attempts
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind}>'
+
+    @staticmethod
+    def enqueue(kind, note_id, conn_curs):
+        # Задача выполняется вместе с транзакцией, изменившей заметку. Ещё не выполненная
+        # задача той же заметки не дублируется, а выполняемая будет выполнена ещё раз
+        conn, cursor = conn_curs
+        query = r"insert into jobs (kind, note_id) values (%s, %s) " \
+                r"on conflict (kind, note_id) do update " \
+                r"set generation = jobs.generation + 1, attempts = 0, last_error = null, " \
+                r"dt_run_after = now();"
+        cursor.execute(query, (kind, note_id))
+
+    @staticmethod
+    def claim(max_attempts, lease):
+        """Захватывает готовую к выполнению задачу на lease секунд и возвращает её или None."""
         conn = get_db_connection()
         cursor = conn.cursor()
+        try:
+            # Задачу, захваченную процессом, который не завершил её за lease секунд
+            # (например, был перезапущен), берёт другой процесс
+            query = r"update jobs set dt_locked = now(), attempts = attempts + 1 " \
+                    r"where id = (" \
+                    r"select id from jobs " \
+                    r"where dt_run_after <= now() and attempts < %s " \
+                    r"and (dt_locked is null or dt_locked < now() - %s * interval '1 second') " \
+                    r"order by dt_run_after, id " \
+                    r"limit 1 " \
+                    r"for update skip locked) " \
+                    r"returning id, kind, note_id, generation, attempts;"
+            cursor.execute(query, (max_attempts, lease))
+            result = cursor.fetchone()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            put_db_connection(conn)
 
-        query = r"select notes.id, user_id, local_id, title, text, dt_added, dt_edited " \
-                r"from notes " \
-                r"left join note_tags on notes.id = note_tags.note_id " \
-                r"where tag_id = %s " \
-                r"order by local_id;"
-        cursor.execute(query, (tag_id,))
-        result = cursor.fetchall()
-        notes = []
-        for row in result:
-            tags = Tag.get_note_tags(row[0], conn_curs=(conn, cursor))
-            note = Note(row[0], row[1], row[2], row[3], row[4], row[5], row[6], tags)
-            notes.append(note)
+        return None if result is None else Job(result[0], result[1], result[2], result[3], result[4])
+
+    @staticmethod
+    def complete(job):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(r"delete from jobs where id = %s and generation = %s;", (job.id, job.generation))
+            if cursor.rowcount == 0:
+                # Заметка изменилась во время выполнения: задача остаётся в очереди
+                cursor.execute(r"update jobs set dt_locked = null where id = %s;", (job.id,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            put_db_connection(conn)
+
+    @staticmethod
+    def fail(job, error, retry_delay):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            query = r"update jobs set dt_locked = null, last_error = %s, " \
+                    r"dt_run_after = now() + %s * interval '1 second' " \
+                    r"where id = %s and generation = %s;"
+            cursor.execute(query, (error, retry_delay, job.id, job.generation))
+            if cursor.rowcount == 0:
+                cursor.execute(r"update jobs set dt_locked = null where id = %s;", (job.id,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            put_db_connection(conn)
+
+    @staticmethod
+    def get_stats(max_attempts):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        query = r"select count(*) filter (where attempts < %s), " \
+                r"count(*) filter (where attempts >= %s), " \
+                r"coalesce(extract(epoch from now() - min(dt_added) filter (where attempts < %s)), 0) " \
+                r"from jobs;"
+        cursor.execute(query, (max_attempts, max_attempts, max_attempts))
+        result = cursor.fetchone()
 
         cursor.close()
-        conn.close()
+        put_db_connection(conn)
 
-        return notes
+        return {'queued': result[0], 'failed': result[1], 'oldest_age_seconds': float(result[2])}
+
+    @staticmethod
+    def retry_failed(max_attempts):
+        """Возвращает в очередь задачи, исчерпавшие попытки. Возвращает их число."""
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        query = r"update jobs set attempts = 0, dt_run_after = now() " \
+                r"where attempts >= %s;"
+        cursor.execute(query, (max_attempts,))
+        count = cursor.rowcount
+        conn.commit()
+
+        cursor.close()
+        put_db_connection(conn)
+        job_added.set()
+
+        return count
+
+
+class NotesPage:
+    """Страница списка заметок, заметки которой читаются по мере обхода.
+
+    notes - итерируемое из не более page_size + 1 заметок: лишняя заметка только
+    показывает, что есть следующая страница. После обхода has_next - есть ли она,
+    last_local_id - local_id последней заметки страницы.
+    """
+    __slots__ = ('_notes', 'page_size', 'has_next', 'last_local_id')
+
+    def __init__(self, notes, page_size):
+        self._notes = notes
+        self.page_size = page_size
+        self.has_next = False
+        self.last_local_id = None
+
+    def __iter__(self):
+        notes = iter(self._notes)
+        try:
+            for i, note in enumerate(notes):
+                if i == self.page_size:
+                    self.has_next = True
+                    break
+                self.last_local_id = note.local_id
+                yield note
+        finally:
+            # Возвращает соединение, даже если обход прерван на лишней заметке
+            if hasattr(notes, 'close'):
+                notes.close()
@@ -0,0 +1,201 @@
+import asyncio
+import itertools
+import os
+import threading
+
+import asyncpg
+
+import config
+from db import Tag, Note, NotesPage
+from md_extentions import RENDER_VERSION
+from tag_query import compile_sql
+
+
+# Асинхронный слой доступа к данным на asyncpg для читающих маршрутов.
+# Пул asyncpg привязан к одному циклу событий, поэтому пул живёт в отдельном потоке
+# со своим циклом, а синхронные представления Flask ждут результаты через run().
+# async-представления Flask 2.0 не используются: каждое из них asgiref выполняет
+# в новом потоке со своим циклом событий
+
+_loop = None
+_loop_pid = None
+_pool = None
+_lock = threading.Lock()
+
+
+async def _create_pool():
+    return await asyncpg.create_pool(
+        host=config.DB_HOST,
+        port=config.DB_PORT,
+        database=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD,
+        min_size=config.ASYNC_DB_POOL_MIN_SIZE,
+        max_size=config.ASYNC_DB_POOL_MAX_SIZE
+    )
+
+
+def _get_loop():
+    global _loop, _loop_pid, _pool
+    # После fork поток с циклом событий не наследуется: создаём цикл и пул заново
+    if _loop is None or _loop_pid != os.getpid():
+        with _lock:
+            if _loop is None or _loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='db-async', daemon=True).start()
+                _pool = asyncio.run_coroutine_threadsafe(_create_pool(), loop).result()
+                _loop = loop
+                _loop_pid = os.getpid()
+    return _loop
+
+
+def run(coro):
+    """Выполняет корутину слоя данных из синхронного кода."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+def close():
+    global _loop, _loop_pid, _pool
+    with _lock:
+        if _loop is not None and _loop_pid == os.getpid():
+            asyncio.run_coroutine_threadsafe(_pool.close(), _loop).result()
+            _loop.call_soon_threadsafe(_loop.stop)
+        _loop = None
+        _loop_pid = None
+        _pool = None
+
+
+class AsyncTag:
+    @staticmethod
+    async def get_user_tags(user_id):
+        query = r"select id, user_id, tag, note_count " \
+                r"from user_tags " \
+                r"where user_id = $1 and note_count > 0 " \
+                r"order by note_count desc, tag;"
+        rows = await _pool.fetch(query, user_id)
+        return [(Tag(row[0], row[1], row[2]), row[3]) for row in rows]
+
+
+class AsyncNote:
+    @staticmethod
+    async def _get_note_row(user_id, note_local_id):
+        query = r"select id, user_id, local_id, title, text, dt_added, dt_edited, html, html_version " \
+                r"from notes " \
+                r"where user_id = $1 and local_id = $2;"
+        return await _pool.fetchrow(query, user_id, note_local_id)
+
+    @staticmethod
+    async def _get_note_tags_by_local_id(user_id, note_local_id):
+        query = r"select tag_id, user_tags.user_id, tag from notes " \
+                r"join note_tags on note_tags.note_id = notes.id " \
+                r"join user_tags on note_tags.tag_id = user_tags.id " \
+                r"where notes.user_id = $1 and notes.local_id = $2;"
+        rows = await _pool.fetch(query, user_id, note_local_id)
+        return {Tag(row[0], row[1], row[2]) for row in rows}
+
+    @staticmethod
+    async def get_note(user_id, note_local_id):
+        """Возвращает заметку с html = None, если сохранённый HTML отсутствует или устарел.
+
+        Рендер нагружает процессор и в цикле событий задержал бы запросы всех потоков,
+        поэтому HTML рендерит вызывающий поток после run().
+        """
+        # Заметка и её теги запрашиваются одновременно по разным соединениям
+        row, tags = await asyncio.gather(
+            AsyncNote._get_note_row(user_id, note_local_id),
+            AsyncNote._get_note_tags_by_local_id(user_id, note_local_id)
+        )
+        if row is None:
+            return None
+        html = row[7] if row[8] == RENDER_VERSION else None
+        return Note(row[0], row[1], row[2], row[3], row[4], row[5], row[6], tags, html)
+
+    @staticmethod
+    async def get_notes_linked_to(user_id, local_note_id):
+        query = r"select notes.id, notes.user_id, local_id, title " \
+                r"from note_links " \
+                r"join notes on notes.id = note_links.source_id " \
+                r"where note_links.user_id = $1 and target_local_id = $2 " \
+                r"order by local_id;"
+        rows = await _pool.fetch(query, user_id, local_note_id)
+        return [Note(row[0], row[1], row[2], row[3], None, None, None, set()) for row in rows]
+
+    @staticmethod
+    async def get_notes_linked_from(user_id, local_note_id):
+        query = r"select notes.id, notes.user_id, notes.local_id, notes.title " \
+                r"from notes source " \
+                r"join note_links on note_links.source_id = source.id " \
+                r"join notes on notes.user_id = note_links.user_id " \
+                r"and notes.local_id = note_links.target_local_id " \
+                r"where source.user_id = $1 and source.local_id = $2 " \
+                r"order by notes.local_id;"
+        rows = await _pool.fetch(query, user_id, local_note_id)
+        return [Note(row[0], row[1], row[2], row[3], None, None, None, set()) for row in rows]
+
+    @staticmethod
+    async def get_note_page(user_id, note_local_id):
+        """Возвращает (заметка, ссылающиеся на неё заметки, заметки, на которые она ссылается).
+
+        Все запросы зависят только от local_id и выполняются одновременно.
+        """
+        return await asyncio.gather(
+            AsyncNote.get_note(user_id, note_local_id),
+            AsyncNote.get_notes_linked_to(user_id, note_local_id),
+            AsyncNote.get_notes_linked_from(user_id, note_local_id)
+        )
+
+    @staticmethod
+    async def _summary_notes(notes_query, tags_query, *args):
+        # Страница заметок и теги тех же заметок запрашиваются одновременно:
+        # tags_query повторяет условие notes_query в подзапросе
+        rows, tag_rows = await asyncio.gather(_pool.fetch(notes_query, *args), _pool.fetch(tags_query, *args))
+        notes_tags = {row[0]: set() for row in rows}
+        for tag_row in tag_rows:
+            if tag_row[0] in notes_tags:
+                notes_tags[tag_row[0]].add(Tag(tag_row[1], tag_row[2], tag_row[3]))
+        return [Note(row[0], row[1], row[2], row[3], None, row[4], row[5], notes_tags[row[0]]) for row in rows]
+
+    @staticmethod
+    async def get_user_notes(user_id, after_local_id=0, page_size=None):
+        page = r"select id, user_id, local_id, title, dt_added, dt_edited " \
+               r"from notes " \
+               r"where user_id = $1 and local_id > $2 " \
+               r"order by local_id " \
+               r"limit $3"
+        tags_query = r"select note_id, tag_id, user_tags.user_id, tag from note_tags " \
+                     r"join user_tags on note_tags.tag_id = user_tags.id " \
+                     r"where note_id in (select id from (" + page + r") page);"
+        limit = page_size + 1 if page_size is not None else None
+        notes = await AsyncNote._summary_notes(page + ';', tags_query, user_id, after_local_id, limit)
+        return NotesPage(notes, page_size)
+
+    @staticmethod
+    async def get_notes_with_tag(user_id, tag_id, after_local_id=0, page_size=None):
+        page = r"select notes.id, notes.user_id, local_id, title, dt_added, dt_edited " \
+               r"from notes " \
+               r"join note_tags on notes.id = note_tags.note_id " \
+               r"where notes.user_id = $1 and tag_id = $2 and local_id > $3 " \
+               r"order by local_id " \
+               r"limit $4"
+        tags_query = r"select note_id, tag_id, user_tags.user_id, tag from note_tags " \
+                     r"join user_tags on note_tags.tag_id = user_tags.id " \
+                     r"where note_id in (select id from (" + page + r") page);"
+        limit = page_size + 1 if page_size is not None else None
+        notes = await AsyncNote._summary_notes(page + ';', tags_query, user_id, tag_id, after_local_id, limit)
+        return NotesPage(notes, page_size)
+
+    @staticmethod
+    async def get_notes_by_tag_query(user_id, expression, after_local_id=0, page_size=None):
+        numbers = itertools.count(3)
+        condition, params = compile_sql(expression, user_id, lambda: f'${next(numbers)}')
+        page = r"select id, user_id, local_id, title, dt_added, dt_edited " \
+               r"from notes " \
+               r"where user_id = $1 and local_id > $2 and " + condition + r" " \
+               r"order by local_id " \
+               r"limit $" + str(next(numbers))
+        tags_query = r"select note_id, tag_id, user_tags.user_id, tag from note_tags " \
+                     r"join user_tags on note_tags.tag_id = user_tags.id " \
+                     r"where note_id in (select id from (" + page + r") page);"
+        limit = page_size + 1 if page_size is not None else None
+        notes = await AsyncNote._summary_notes(page + ';', tags_query, user_id, after_local_id, *params, limit)
+        return NotesPage(notes, page_size)
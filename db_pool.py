@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """Ограниченный потокобезопасный пул соединений psycopg2.
+
+    В отличие от psycopg2.pool.ThreadedConnectionPool, при исчерпании пула
+    ждёт освобождения соединения до timeout секунд, закрывает долго
+    простаивающие соединения и проверяет соединение перед выдачей.
+    """
+
+    def __init__(self, min_size, max_size, timeout, idle_timeout, health_check_interval, **conn_kwargs):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('invalid pool size')
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._conn_kwargs = conn_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, last_used)], последнее возвращённое соединение в конце
+        self._size = 0  # выданные и простаивающие соединения
+        self._closed = False
+
+        self._stats = {
+            'connections_created': 0,
+            'connections_closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'exhausted': 0,
+            'health_check_failures': 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._conn_kwargs)
+        with self._cond:
+            self._stats['connections_created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats['connections_closed'] += 1
+            self._cond.notify()
+
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute('select 1;')
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _pop_expired(self, now):
+        """Забирает из пула соединения, простаивающие дольше idle_timeout. Вызывать под self._cond."""
+        expired = []
+        while self._idle and self._size - len(expired) > self.min_size \
+                and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.pop(0)[0])
+        return expired
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+
+        while True:
+            conn = None
+            last_used = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolError('connection pool is closed')
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['exhausted'] += 1
+                        logger.warning('Пул соединений исчерпан: %d соединений заняты дольше %.1f с',
+                                       self.max_size, self.timeout)
+                        raise PoolError('connection pool exhausted')
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif time.monotonic() - last_used > self.health_check_interval and not self._is_alive(conn):
+                with self._cond:
+                    self._stats['health_check_failures'] += 1
+                self._discard(conn)
+                continue
+
+            wait_time = time.monotonic() - start
+            with self._cond:
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['waits'] += 1
+                self._stats['wait_time_total'] += wait_time
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+            return conn
+
+    def putconn(self, conn, close=False):
+        if not conn.closed and not close:
+            status = conn.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        if conn.closed or close or self._closed:
+            self._discard(conn)
+            return
+
+        now = time.monotonic()
+        with self._cond:
+            self._idle.append((conn, now))
+            expired = self._pop_expired(now)
+            self._cond.notify()
+        for expired_conn in expired:
+            self._discard(expired_conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+        for conn in idle:
+            self._discard(conn)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['max_size'] = self.max_size
+        return stats
@@ -0,0 +1,125 @@
+from collections import namedtuple
+
+import config
+from db import get_db_connection, put_db_connection
+
+
+# Окрестность заметки в графе ссылок для графического представления: заметки на расстоянии
+# не больше depth переходов по ссылкам в обе стороны и, по желанию, по общим тегам
+
+NoteGraph = namedtuple('NoteGraph', ['nodes', 'edges', 'truncated'])
+
+
+def _walk(cursor, user_id, note_local_id, depth, max_nodes, tag_edges):
+    # Обход в ширину одним рекурсивным запросом: строка walk - целый уровень обхода,
+    # frontier - заметки уровня, seen - все найденные заметки. Каждая заметка попадает
+    # в обход один раз, поэтому число строк не растёт экспоненциально с глубиной,
+    # а уровень ограничен max_nodes заметками. Но соседи собираются до limit, поэтому
+    # переходы по тегам, у которых больше GRAPH_MAX_TAG_NOTES заметок, пропускаются:
+    # иначе один частый тег делает каждый уровень размером со все заметки тега
+    query = r"with recursive walk(depth, frontier, seen) as (" \
+            r"select 0, array[notes.local_id], array[notes.local_id] " \
+            r"from notes where notes.user_id = %(user_id)s and notes.local_id = %(local_id)s " \
+            r"union all " \
+            r"select walk.depth + 1, next.ids, walk.seen || next.ids " \
+            r"from walk cross join lateral (select array(" \
+            r"select neighbour from (" \
+            r"select target.local_id as neighbour " \
+            r"from notes source " \
+            r"join note_links on note_links.source_id = source.id " \
+            r"join notes target on target.user_id = note_links.user_id " \
+            r"and target.local_id = note_links.target_local_id " \
+            r"where source.user_id = %(user_id)s and source.local_id = any(walk.frontier) " \
+            r"union " \
+            r"select source.local_id " \
+            r"from note_links " \
+            r"join notes source on source.id = note_links.source_id " \
+            r"where note_links.user_id = %(user_id)s and note_links.target_local_id = any(walk.frontier) " \
+            r"union " \
+            r"select other.local_id " \
+            r"from notes current " \
+            r"join note_tags on note_tags.note_id = current.id " \
+            r"join user_tags on user_tags.id = note_tags.tag_id " \
+            r"and user_tags.note_count <= %(max_tag_notes)s " \
+            r"join note_tags shared on shared.tag_id = note_tags.tag_id " \
+            r"join notes other on other.id = shared.note_id " \
+            r"where %(tag_edges)s and current.user_id = %(user_id)s and current.local_id = any(walk.frontier)" \
+            r") neighbours " \
+            r"where neighbour <> all(walk.seen) " \
+            r"order by neighbour " \
+            r"limit %(max_nodes)s" \
+            r") ids) next " \
+            r"where walk.depth < %(depth)s and cardinality(walk.frontier) > 0 " \
+            r"and cardinality(walk.seen) <= %(max_nodes)s" \
+            r") " \
+            r"select notes.id, walk_nodes.local_id, notes.title, walk_nodes.depth " \
+            r"from (select depth, unnest(frontier) local_id from walk) walk_nodes " \
+            r"join notes on notes.user_id = %(user_id)s and notes.local_id = walk_nodes.local_id " \
+            r"order by walk_nodes.depth, walk_nodes.local_id " \
+            r"limit %(limit)s;"
+    cursor.execute(query, {'user_id': user_id, 'local_id': note_local_id, 'depth': depth,
+                           'max_nodes': max_nodes, 'limit': max_nodes + 1, 'tag_edges': tag_edges,
+                           'max_tag_notes': config.GRAPH_MAX_TAG_NOTES})
+    return cursor.fetchall()
+
+
+def _link_edges(cursor, note_ids, local_ids):
+    query = r"select source.local_id, note_links.target_local_id " \
+            r"from note_links " \
+            r"join notes source on source.id = note_links.source_id " \
+            r"where note_links.source_id = any(%s) and note_links.target_local_id = any(%s) " \
+            r"order by source.local_id, note_links.target_local_id;"
+    cursor.execute(query, (note_ids, local_ids))
+    return [{'source': row[0], 'target': row[1], 'type': 'link'} for row in cursor.fetchall()]
+
+
+def _tag_edges(cursor, note_ids, limit):
+    # Теги читаются только для заметок окрестности, пары составляются уже из них
+    query = r"with node_tags as (" \
+            r"select notes.local_id, note_tags.tag_id " \
+            r"from note_tags " \
+            r"join notes on notes.id = note_tags.note_id " \
+            r"where note_tags.note_id = any(%s)" \
+            r") " \
+            r"select a.local_id, b.local_id, array_agg(user_tags.tag order by user_tags.tag) " \
+            r"from node_tags a " \
+            r"join node_tags b on b.tag_id = a.tag_id and a.local_id < b.local_id " \
+            r"join user_tags on user_tags.id = a.tag_id " \
+            r"group by a.local_id, b.local_id " \
+            r"order by count(*) desc, a.local_id, b.local_id " \
+            r"limit %s;"
+    cursor.execute(query, (note_ids, limit))
+    return [{'source': row[0], 'target': row[1], 'type': 'tag', 'tags': row[2]} for row in cursor.fetchall()]
+
+
+def note_graph(user_id, note_local_id, depth=1, max_nodes=None, tag_edges=False):
+    """Возвращает окрестность заметки NoteGraph или None, если заметки нет.
+
+    nodes - [{id, title, depth}] в порядке удаления от заметки, edges - ссылки
+    {source, target, type='link'} и при tag_edges пары заметок с общими тегами
+    {source, target, type='tag', tags}. truncated - окрестность обрезана до max_nodes заметок.
+    """
+    depth = max(0, min(depth, config.GRAPH_MAX_DEPTH))
+    max_nodes = max(1, min(max_nodes or config.GRAPH_MAX_NODES, config.GRAPH_MAX_NODES))
+
+    conn = get_db_connection(read_only=True)
+    cursor = conn.cursor()
+
+    rows = _walk(cursor, user_id, note_local_id, depth, max_nodes, tag_edges)
+    if len(rows) == 0:
+        cursor.close()
+        put_db_connection(conn)
+        return None
+
+    truncated = len(rows) > max_nodes
+    rows = rows[:max_nodes]
+    note_ids = [row[0] for row in rows]
+    nodes = [{'id': row[1], 'title': row[2], 'depth': row[3]} for row in rows]
+    edges = _link_edges(cursor, note_ids, [row[1] for row in rows])
+    if tag_edges:
+        edges.extend(_tag_edges(cursor, note_ids, config.GRAPH_MAX_TAG_EDGES))
+
+    cursor.close()
+    put_db_connection(conn)
+
+    return NoteGraph(nodes, edges, truncated)
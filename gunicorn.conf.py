@@ -0,0 +1,44 @@
+import multiprocessing
+import os
+
+import db
+import db_async
+import jobs
+import tag_sweep
+
+
+# Запуск: gunicorn -c gunicorn.conf.py 'main:create_app()'
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:80')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+
+# Приложение загружается в мастер-процессе до fork, поэтому воркеры стартуют быстрее
+preload_app = True
+
+# Время на завершение текущих запросов после SIGTERM
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+keepalive = 5
+
+# Периодический перезапуск воркеров ограничивает рост памяти
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Каждому воркеру свой пул соединений с БД, свой поток удаления тегов и свои потоки задач
+    db.reset_pool()
+    tag_sweep.start()
+    jobs.start()
+
+
+def worker_exit(server, worker):
+    tag_sweep.stop()
+    jobs.stop()
+    db.close_pool()
+    db_async.close()
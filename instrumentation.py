@@ -0,0 +1,220 @@
+import ipaddress
+import json
+import logging
+import threading
+import time
+
+from flask import Response, abort, g, has_app_context, request
+from psycopg2.extensions import cursor as base_cursor
+
+import config
+
+
+ENABLED = config.INSTRUMENTATION_ENABLED
+
+logger = logging.getLogger('zettelkasten.requests')
+
+# Границы корзин гистограммы времени ответа, в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+SLOWEST_QUERY_MAX_LENGTH = 200
+
+# Сети, с которых доступен /metrics
+METRICS_ALLOWED_NETWORKS = [ipaddress.ip_network(addr, strict=False) for addr in config.METRICS_ALLOWED_ADDRS]
+
+
+class RequestStats:
+    __slots__ = ('query_count', 'db_time', 'slowest_query', 'slowest_query_time', 'render_time')
+
+    def __init__(self):
+        self.query_count = 0
+        self.db_time = 0.0
+        self.slowest_query = None
+        self.slowest_query_time = 0.0
+        self.render_time = 0.0
+
+
+def get_request_stats():
+    if has_app_context():
+        return g.get('request_stats')
+    return None
+
+
+def record_query(query, duration):
+    stats = get_request_stats()
+    if stats is None:
+        return
+    stats.query_count += 1
+    stats.db_time += duration
+    if duration > stats.slowest_query_time:
+        stats.slowest_query_time = duration
+        stats.slowest_query = query
+
+
+def record_render(duration):
+    stats = get_request_stats()
+    if stats is not None:
+        stats.render_time += duration
+
+
+class InstrumentedCursor(base_cursor):
+    """Курсор, замеряющий время выполнения каждого запроса для статистики текущего запроса Flask."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(query, time.perf_counter() - start)
+
+
+def connection_kwargs():
+    # Без инструментирования соединения используют стандартный курсор psycopg2
+    if ENABLED:
+        return {'cursor_factory': InstrumentedCursor}
+    return {}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+# Метрики процесса; при нескольких воркерах gunicorn у каждого воркера свои
+_metrics_lock = threading.Lock()
+_latency = {}  # (method, route) -> Histogram
+_db_queries = {}  # (method, route) -> число SQL-запросов
+_db_time = {}  # (method, route) -> суммарное время в БД
+
+# Функции, возвращающие {имя метрики: значение} для /metrics
+metrics_sources = []
+
+
+def _route_key():
+    rule = request.url_rule
+    return request.method, rule.rule if rule is not None else 'unmatched'
+
+
+def _before_request():
+    g.request_stats = RequestStats()
+    g.request_start = time.perf_counter()
+
+
+def _record(stats, key, status, duration):
+    with _metrics_lock:
+        histogram = _latency.get(key)
+        if histogram is None:
+            histogram = _latency[key] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(duration)
+        _db_queries[key] = _db_queries.get(key, 0) + stats.query_count
+        _db_time[key] = _db_time.get(key, 0.0) + stats.db_time
+
+    slowest_query = stats.slowest_query
+    if isinstance(slowest_query, bytes):
+        slowest_query = slowest_query.decode('utf-8', 'replace')
+    logger.info(json.dumps({
+        'method': key[0],
+        'route': key[1],
+        'status': status,
+        'duration_ms': round(duration * 1000, 2),
+        'db_queries': stats.query_count,
+        'db_time_ms': round(stats.db_time * 1000, 2),
+        'db_slowest_ms': round(stats.slowest_query_time * 1000, 2),
+        'db_slowest_query': slowest_query[:SLOWEST_QUERY_MAX_LENGTH] if slowest_query else None,
+        'markdown_ms': round(stats.render_time * 1000, 2),
+    }, ensure_ascii=False))
+
+
+def _after_request(response):
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+    start = g.request_start
+    key = _route_key()
+
+    if response.is_streamed:
+        # Тело потокового ответа рендерится и читает БД уже после отправки заголовков,
+        # поэтому Server-Timing с неполным числом запросов не добавляется, а метрики
+        # и строка лога записываются, когда сервер закроет ответ
+        status = response.status_code
+        response.call_on_close(lambda: _record(stats, key, status, time.perf_counter() - start))
+        return response
+
+    duration = time.perf_counter() - start
+    _record(stats, key, response.status_code, duration)
+
+    timings = [
+        f'db;dur={stats.db_time * 1000:.2f};desc="{stats.query_count} queries"',
+        f'db-slowest;dur={stats.slowest_query_time * 1000:.2f}',
+        f'markdown;dur={stats.render_time * 1000:.2f}',
+        f'total;dur={duration * 1000:.2f}',
+    ]
+    response.headers.add('Server-Timing', ', '.join(timings))
+
+    return response
+
+
+def _labels(key):
+    method, route = key
+    return f'method="{method}",route="{route}"'
+
+
+def metrics():
+    try:
+        remote_addr = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        return abort(404)
+    if not any(remote_addr in network for network in METRICS_ALLOWED_NETWORKS):
+        return abort(404)
+
+    lines = []
+    with _metrics_lock:
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for key, histogram in sorted(_latency.items()):
+            labels = _labels(key)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'http_request_duration_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'http_request_duration_seconds_count{{{labels}}} {histogram.count}')
+
+        lines.append('# TYPE db_queries_total counter')
+        for key, value in sorted(_db_queries.items()):
+            lines.append(f'db_queries_total{{{_labels(key)}}} {value}')
+
+        lines.append('# TYPE db_time_seconds_total counter')
+        for key, value in sorted(_db_time.items()):
+            lines.append(f'db_time_seconds_total{{{_labels(key)}}} {value}')
+
+    for source in metrics_sources:
+        for name, value in source().items():
+            lines.append(f'{name} {value}')
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    if ENABLED:
+        app.before_request(_before_request)
+        app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+import traceback
+
+import config
+import db
+import instrumentation
+from db import Job, Note
+
+
+# Фоновая очередь задач, производных от сохранения заметки. Задачи хранятся в таблице jobs
+# и ставятся в той же транзакции, что и изменение заметки, поэтому переживают перезапуск.
+# Каждый процесс выполняет их в JOB_WORKERS потоках; задачи разбираются через
+# for update skip locked, так что потоки разных процессов не мешают друг другу
+
+logger = logging.getLogger(__name__)
+
+# Вид задачи -> функция от id заметки
+HANDLERS = {
+    Job.NOTE_DERIVED: Note.update_derived,
+}
+
+_threads = []
+_threads_pid = None
+_stop = threading.Event()
+_lock = threading.Lock()
+_processed_total = 0
+_errors_total = 0
+_retries_total = 0
+
+
+def run_one():
+    """Выполняет одну готовую задачу. Возвращает False, если готовых задач нет."""
+    global _processed_total, _errors_total, _retries_total
+    job = Job.claim(config.JOB_MAX_ATTEMPTS, config.JOB_LEASE)
+    if job is None:
+        return False
+    try:
+        HANDLERS[job.kind](job.note_id)
+    except Exception as e:
+        # Повторы с экспоненциально растущей паузой; после JOB_MAX_ATTEMPTS попыток
+        # задача остаётся в таблице с последней ошибкой ("python manage.py jobs --retry-failed")
+        logger.exception('Ошибка задачи %s %s заметки %s', job.id, job.kind, job.note_id)
+        error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        Job.fail(job, error, config.JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+        with _lock:
+            _errors_total += 1
+            if job.attempts < config.JOB_MAX_ATTEMPTS:
+                _retries_total += 1
+        return True
+    Job.complete(job)
+    with _lock:
+        _processed_total += 1
+    return True
+
+
+def drain():
+    """Выполняет в текущем потоке все готовые задачи, возвращает их число."""
+    count = 0
+    while run_one():
+        count += 1
+    return count
+
+
+def _run():
+    while not _stop.is_set():
+        # Событие сбрасывается до поиска задачи: задача, поставленная после неудачного
+        # поиска, снова его установит. Задачи других процессов и отложенные повторы
+        # находятся опросом таблицы
+        db.job_added.clear()
+        try:
+            if run_one():
+                continue
+        except Exception:
+            logger.exception('Ошибка очереди задач')
+        db.job_added.wait(config.JOB_POLL_INTERVAL)
+
+
+def start():
+    # Потоки не переживают fork, поэтому запускаются в каждом процессе отдельно
+    global _threads, _threads_pid
+    if config.JOB_WORKERS <= 0:
+        return
+    with _lock:
+        if not _threads or _threads_pid != os.getpid():
+            _stop.clear()
+            _threads = [threading.Thread(target=_run, name=f'jobs-{n}', daemon=True)
+                        for n in range(config.JOB_WORKERS)]
+            for thread in _threads:
+                thread.start()
+            _threads_pid = os.getpid()
+
+
+def stop():
+    global _threads, _threads_pid
+    _stop.set()
+    db.job_added.set()
+    with _lock:
+        _threads = []
+        _threads_pid = None
+
+
+def _metrics():
+    metrics = {f'jobs_{name}': value for name, value in Job.get_stats(config.JOB_MAX_ATTEMPTS).items()}
+    with _lock:
+        metrics['jobs_processed_total'] = _processed_total
+        metrics['jobs_errors_total'] = _errors_total
+        metrics['jobs_retries_total'] = _retries_total
+    return metrics
+
+
+def init_app(app):
+    instrumentation.metrics_sources.append(_metrics)
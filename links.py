@@ -0,0 +1,21 @@
+import re
+
+
+# Ссылка на другую заметку в markdown: [текст](local_id). \d совпал бы и с цифрами
+# других алфавитов, которые int() тоже понимает
+NOTE_LINK_RE = re.compile(r'\[[^\]]*\]\(([0-9]+)\)')
+
+# local_id хранится в int: ссылки на большие номера не могут указывать на заметку
+MAX_LOCAL_ID = 2 ** 31 - 1
+
+
+def extract_links(text):
+    """Возвращает множество local_id заметок, на которые ссылается текст."""
+    if not text:
+        return set()
+    return {int(local_id) for local_id in NOTE_LINK_RE.findall(text) if int(local_id) <= MAX_LOCAL_ID}
+
+
+def note_link(local_id, title):
+    """Ссылка на заметку в markdown. Квадратные скобки из заголовка убираются: с ними ссылка не распознаётся."""
+    return f"[{title.replace('[', '').replace(']', '')}]({local_id})"
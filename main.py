@@ -1,17 +1,38 @@
+import glob
+import hashlib
+import logging
+import os
+import zipfile
 from urllib.parse import urlparse, urljoin
-from flask import Flask, render_template, flash, redirect, url_for, request, abort
+from flask import Flask, render_template, flash, redirect, url_for, request, abort, g, session, make_response, \
+    Response, stream_with_context, jsonify, get_flashed_messages
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, SubmitField, PasswordField, BooleanField, TextAreaField
 from wtforms.validators import DataRequired, Email
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-import markdown
-import md_extentions
-
+import autocomplete
+import config
+import db
+import db_async
+import graph
+import instrumentation
+import jobs
+import related
+import search
+import tag_query
+import tag_sweep
+import vault
 from db import User, Note, Tag
+from db_async import AsyncNote, AsyncTag
+from links import note_link
+from md_extentions import RENDER_VERSION, render_markdown
 
 
 app = Flask(__name__)
 app.secret_key = b'Some secret key'
+app.config['MAX_CONTENT_LENGTH'] = config.MAX_UPLOAD_SIZE
+app.add_template_filter(tag_query.quote, 'tag_query')
 
 
 login_manager = LoginManager()
@@ -47,6 +68,34 @@ class SearchForm(FlaskForm):
     submit = SubmitField('Найти')
 
 
+class ImportForm(FlaskForm):
+    archive = FileField(validators=[FileRequired()])
+    submit = SubmitField('Импортировать')
+
+
+# Число фрагментов шаблона, накапливаемых перед отправкой очередной порции страницы
+TEMPLATE_STREAM_BUFFER = 100
+
+# Сколько ошибок импорта показывать после загрузки архива
+IMPORT_ERRORS_SHOWN = 10
+
+
+def _app_version():
+    if config.APP_VERSION:
+        return config.APP_VERSION
+    # Страницы зависят от шаблонов и кода приложения
+    digest = hashlib.sha1()
+    root = os.path.dirname(os.path.abspath(__file__))
+    for pattern in ('*.py', os.path.join('templates', '*.html')):
+        for path in sorted(glob.glob(os.path.join(root, pattern))):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+APP_VERSION = _app_version()
+
+
 def is_safe_url(target):
     ref_url = urlparse(request.host_url)
     test_url = urlparse(urljoin(request.host_url, target))
@@ -65,9 +114,70 @@ def parse_tags(tags_data):
     return tags_str
 
 
+def not_modified(note_local_id=None):
+    """Возвращает ответ 304, если у клиента актуальная копия страницы, иначе None.
+
+    Проверка делается до запросов страницы и рендера markdown: валидаторы считаются
+    по метке изменений заметок пользователя (и по dt_edited заметки note_local_id)
+    и добавляются к отрисованной странице в set_validators.
+    """
+    # Страница с непоказанными сообщениями flash отличается от сохранённой копии
+    if session.get('_flashes'):
+        return None
+    stamp = User.get_notes_stamp(current_user.id, note_local_id)
+    # Метка нужна и представлению, например для похожих заметок: повторно она не запрашивается
+    g.notes_stamp = stamp
+    if stamp is None or (note_local_id is not None and stamp.note_dt_edited is None):
+        return None
+
+    # Копия страницы другого пользователя в том же браузере не должна подойти
+    key = f'{current_user.id}:{stamp.version}:{stamp.note_dt_edited}:{RENDER_VERSION}:{APP_VERSION}'
+    g.page_etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    # Last-Modified передаётся с точностью до секунды
+    g.page_last_modified = stamp.dt_changed.replace(microsecond=0)
+
+    if request.if_none_match:
+        modified = not request.if_none_match.contains_weak(g.page_etag)
+    elif request.if_modified_since:
+        modified = g.page_last_modified > request.if_modified_since
+    else:
+        modified = True
+    if modified:
+        return None
+    return make_response('', 304)
+
+
+@app.after_request
+def set_validators(response):
+    if 'page_etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.page_etag, weak=True)
+        response.last_modified = g.page_last_modified
+        # Страницы личные: общие кеши их не хранят, а браузер проверяет копию при каждом запросе
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def render_list(template_name, **context):
+    """Отдаёт страницу списка по мере рендера шаблона.
+
+    Первые байты страницы уходят клиенту до того, как прочитаны последние строки
+    из БД. В Flask 2.0 нет flask.stream_template, поэтому поток шаблона собирается здесь.
+    """
+    if not config.STREAM_TEMPLATES:
+        return render_template(template_name, **context)
+    # Заголовки с cookie сессии уходят до рендера шаблона: сообщения flash извлекаются
+    # из сессии заранее, шаблон получит их из кеша запроса
+    get_flashed_messages()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(TEMPLATE_STREAM_BUFFER)
+    return Response(stream_with_context(stream))
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get_user(user_id)
+    return User.get_cached_user(user_id)
 
 
 @app.errorhandler(404)
@@ -146,35 +256,131 @@ def account():
 @app.route('/notes', methods=['GET'])
 @login_required
 def notes_page():
+    response = not_modified()
+    if response is not None:
+        return response
+
     form = SearchForm(request.args)
     search_query = request.args.get('q', None)
     filter_tag_id = request.args.get('t', None)
+
     if search_query is not None:
-        notes = Note.search_notes(current_user.id, search_query)
+        page = max(request.args.get('page', 1, type=int), 1)
+        fuzzy = request.args.get('fuzzy', 0, type=int) == 1
+        result = search.search_notes(current_user.id, search_query, page, config.NOTES_PAGE_SIZE, fuzzy)
+        start_url = url_for('notes_page', q=search_query) if page > 1 else None
+        next_url = url_for('notes_page', q=search_query, page=page + 1,
+                           fuzzy=1 if result.fuzzy else None) if result.has_next else None
+        return render_list('notes.html', notes=result.notes, form=form, snippets=result.snippets,
+                           fuzzy=result.fuzzy, start_url=start_url, next_url=next_url)
+
+    after_local_id = request.args.get('after', 0, type=int)
+    page_size = config.NOTES_PAGE_SIZE
+    tag_query_str = request.args.get('tq', None)
+    tag_query_error = None
+    if tag_query_str is not None:
+        filter_tag_id = None
+        try:
+            expression = tag_query.parse(tag_query_str)
+        except tag_query.TagQueryError as e:
+            tag_query_error = str(e)
+            notes = []
+        else:
+            if config.ASYNC_DB_ENABLED:
+                notes = db_async.run(
+                    AsyncNote.get_notes_by_tag_query(current_user.id, expression, after_local_id, page_size))
+            else:
+                notes = Note.get_notes_by_tag_query(current_user.id, expression, after_local_id, page_size)
     elif filter_tag_id is not None:
         try:
             filter_tag_id = int(filter_tag_id)
-            notes = Note.get_notes_with_tag(filter_tag_id)
         except ValueError:
+            filter_tag_id = None
             notes = []
+        else:
+            if config.ASYNC_DB_ENABLED:
+                notes = db_async.run(
+                    AsyncNote.get_notes_with_tag(current_user.id, filter_tag_id, after_local_id, page_size))
+            else:
+                notes = Note.get_notes_with_tag(current_user.id, filter_tag_id, after_local_id, page_size)
+    elif config.ASYNC_DB_ENABLED:
+        notes = db_async.run(AsyncNote.get_user_notes(current_user.id, after_local_id, page_size))
     else:
-        notes = Note.get_user_notes(current_user.id)
+        notes = Note.get_user_notes(current_user.id, after_local_id, page_size)
 
-    return render_template('notes.html', notes=notes, form=form)
+    # Заметки читаются во время вывода шаблона, поэтому ссылку на следующую страницу
+    # шаблон строит сам после списка по notes.has_next и notes.last_local_id
+    page_args = {'t': filter_tag_id, 'tq': tag_query_str}
+    start_url = url_for('notes_page', **page_args) if after_local_id else None
+
+    return render_list('notes.html', notes=notes, form=form, start_url=start_url, page_args=page_args,
+                       tag_query=tag_query_str, tag_query_error=tag_query_error)
 
 
 @app.route('/note/<int:note_local_id>')
 @login_required
 def note_page(note_local_id):
-    note = Note.get_note(current_user.id, note_local_id)
+    response = not_modified(note_local_id)
+    if response is not None:
+        return response
+
+    if config.ASYNC_DB_ENABLED:
+        note, links_from, links_to = db_async.run(AsyncNote.get_note_page(current_user.id, note_local_id))
+        if note is not None and note.html is None:
+            note.html = render_markdown(note.text)
+    else:
+        note = Note.get_note(current_user.id, note_local_id)
+        if note is not None:
+            links_from = Note.get_notes_linked_to(current_user.id, note.local_id)
+            links_to = Note.get_notes_linked_from(note.id)
     if note is None:
         flash('Нет заметки с таким идентификатором')
         return abort(404)
+    related_notes = related.get_related_notes(current_user.id, note.local_id, stamp=g.get('notes_stamp'))
+    if related_notes is None:
+        # Страница без ещё не построенных похожих заметок не должна отдаваться из кеша клиента
+        g.pop('page_etag', None)
+
+    return render_template('note.html', note=note, md=note.html, links_from=links_from, links_to=links_to,
+                           related_notes=related_notes)
+
+
+@app.route('/note/<int:note_local_id>/graph')
+@login_required
+def note_graph(note_local_id):
+    """Окрестность заметки в JSON для графа: ?depth=глубина&limit=заметок&tags=1 - рёбра по общим тегам."""
+    response = not_modified()
+    if response is not None:
+        return response
+
+    depth = request.args.get('depth', 1, type=int)
+    limit = request.args.get('limit', config.GRAPH_MAX_NODES, type=int)
+    tag_edges = request.args.get('tags', 0, type=int) == 1
+    result = graph.note_graph(current_user.id, note_local_id, depth, limit, tag_edges)
+    if result is None:
+        return jsonify(error='Нет заметки с таким идентификатором'), 404
 
-    links_from = Note.get_notes_linked_to(current_user.id, note.local_id)
-    md = markdown.markdown(note.text, extensions=['fenced_code', md_extentions.StrikeExtension()])
+    return jsonify(root=note_local_id, nodes=result.nodes, edges=result.edges, truncated=result.truncated)
 
-    return render_template('note.html', note=note, md=md, links_from=links_from)
+
+@app.route('/autocomplete/tags')
+@login_required
+def autocomplete_tags():
+    """Теги пользователя, начинающиеся с ?q=, в JSON: [{tag, count}]."""
+    index = autocomplete.get_index(current_user.id)
+    limit = min(request.args.get('limit', config.AUTOCOMPLETE_LIMIT, type=int), config.AUTOCOMPLETE_LIMIT)
+    tags = index.find_tags(request.args.get('q', ''), limit) if index is not None else []
+    return jsonify([{'tag': tag, 'count': count} for tag, count in tags])
+
+
+@app.route('/autocomplete/notes')
+@login_required
+def autocomplete_notes():
+    """Заметки, в заголовке которых есть слова ?q=, в JSON: [{id, title, link}], link - ссылка в markdown."""
+    index = autocomplete.get_index(current_user.id)
+    limit = min(request.args.get('limit', config.AUTOCOMPLETE_LIMIT, type=int), config.AUTOCOMPLETE_LIMIT)
+    notes = index.find_notes(request.args.get('q', ''), limit) if index is not None else []
+    return jsonify([{'id': local_id, 'title': title, 'link': note_link(local_id, title)} for local_id, title in notes])
 
 
 @app.route('/add-note', methods=['GET', 'POST'])
@@ -239,11 +445,68 @@ def delete_note(note_local_id):
     return redirect(url_for('notes_page'))
 
 
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_notes():
+    form = ImportForm()
+    if form.validate_on_submit():
+        try:
+            result = vault.import_vault(current_user.id, form.archive.data.stream)
+        except zipfile.BadZipFile:
+            flash('Файл не является zip-архивом')
+        else:
+            flash(f'Импортировано заметок: {result.imported}')
+            for name, message in result.errors[:IMPORT_ERRORS_SHOWN]:
+                flash(f'{name} не импортирован: {message}')
+            if len(result.errors) > IMPORT_ERRORS_SHOWN:
+                flash(f'Не импортировано ещё файлов: {len(result.errors) - IMPORT_ERRORS_SHOWN}')
+            return redirect(url_for('notes_page'))
+    return render_template('import.html', form=form)
+
+
+@app.route('/export')
+@login_required
+def export_notes():
+    # Архив отдаётся по мере чтения заметок из БД, без сборки целиком в памяти
+    return Response(stream_with_context(vault.export_vault(current_user.id)), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=zettelkasten.zip'})
+
+
 @app.route('/tags')
 @login_required
 def tags_page():
-    tags = Tag.get_user_tags(current_user.id)
-    return render_template('tags.html', tags=tags)
+    response = not_modified()
+    if response is not None:
+        return response
 
-
-app.run('0.0.0.0', 80, False)
+    if config.ASYNC_DB_ENABLED:
+        tags = db_async.run(AsyncTag.get_user_tags(current_user.id))
+    else:
+        tags = Tag.get_user_tags(current_user.id)
+    return render_list('tags.html', tags=tags)
+
+
+_app_initialized = False
+
+
+def create_app():
+    # Точка входа для WSGI-сервера: gunicorn -c gunicorn.conf.py 'main:create_app()'
+    global _app_initialized
+    if not _app_initialized:
+        logging.basicConfig(level=config.LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+        db.init_app(app)
+        instrumentation.init_app(app)
+        tag_sweep.init_app(app)
+        related.init_app(app)
+        autocomplete.init_app(app)
+        jobs.init_app(app)
+        _app_initialized = True
+    return app
+
+
+if __name__ == '__main__':
+    # Режим разработки: один процесс со встроенным сервером Werkzeug
+    create_app()
+    tag_sweep.start()
+    jobs.start()
+    app.run('0.0.0.0', 80, False)
@@ -0,0 +1,225 @@
+import argparse
+import sys
+
+from psycopg2.extras import execute_values
+
+import config
+import jobs
+import migrate
+import plan_check
+import seed
+import tag_sweep
+import vault
+from db import get_db_connection, put_db_connection, Job
+from links import extract_links
+from md_extentions import RENDER_VERSION, render_markdown
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_links(args):
+    """Заполняет note_links по текстам всех существующих заметок."""
+    conn = get_db_connection()
+    # Именованный курсор читает заметки с сервера порциями, не загружая все в память
+    read_cursor = conn.cursor(name='backfill_links')
+    read_cursor.itersize = BATCH_SIZE
+    write_cursor = conn.cursor()
+
+    read_cursor.execute(r"select id, user_id, text from notes order by id;")
+    processed = 0
+    while True:
+        rows = read_cursor.fetchmany(BATCH_SIZE)
+        if len(rows) == 0:
+            break
+
+        values = []
+        for note_id, user_id, text in rows:
+            for target_local_id in extract_links(text):
+                values.append((note_id, user_id, target_local_id))
+        if len(values) > 0:
+            execute_values(write_cursor,
+                           r"insert into note_links (source_id, user_id, target_local_id) "
+                           r"values %s on conflict do nothing;",
+                           values)
+
+        processed += len(rows)
+        print(f'Обработано заметок: {processed}')
+
+    # Ссылки выводятся на страницах заметок: сохранённые клиентами копии устарели
+    write_cursor.execute(r"update users set notes_version = notes_version + 1, dt_notes_changed = now();")
+
+    read_cursor.close()
+    write_cursor.close()
+    conn.commit()
+    put_db_connection(conn)
+
+
+def rerender_notes(args):
+    """Перерендеривает HTML заметок, сохранённый другой версией рендера."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Порции читаются по id и сохраняются каждая в своей транзакции,
+    # чтобы не держать одну транзакцию и снимок на всю таблицу
+    query = r"select id, text from notes " \
+            r"where id > %s and (%s or html is null or html_version is distinct from %s) " \
+            r"order by id limit %s;"
+    last_id = 0
+    processed = 0
+    try:
+        while True:
+            cursor.execute(query, (last_id, args.all, RENDER_VERSION, BATCH_SIZE))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                break
+
+            # Если текст изменили после чтения, HTML старого текста не записывается:
+            # изменение сбросило html и поставило задачу рендера нового текста
+            values = [(note_id, text, render_markdown(text), RENDER_VERSION) for note_id, text in rows]
+            execute_values(cursor,
+                           r"update notes set html = v.html, html_version = v.html_version "
+                           r"from (values %s) as v (id, text, html, html_version) "
+                           r"where notes.id = v.id and notes.text is not distinct from v.text;",
+                           values)
+            conn.commit()
+
+            last_id = rows[-1][0]
+            processed += len(rows)
+            print(f'Перерендерено заметок: {processed}')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        put_db_connection(conn)
+
+
+def sweep_tags(args):
+    print(f'Удалено неиспользуемых тегов: {tag_sweep.sweep()}')
+
+
+def run_jobs(args):
+    print(f'Выполнено задач: {jobs.drain()}')
+
+
+def show_jobs(args):
+    if args.retry_failed:
+        print(f'Возвращено в очередь задач: {Job.retry_failed(config.JOB_MAX_ATTEMPTS)}')
+    stats = Job.get_stats(config.JOB_MAX_ATTEMPTS)
+    print(f'В очереди: {stats["queued"]}, исчерпали попытки: {stats["failed"]}, '
+          f'старейшая ждёт: {stats["oldest_age_seconds"]:.0f} с')
+
+
+def run_migrations(args):
+    applied = migrate.migrate()
+    if applied:
+        print('Применены миграции: ' + ', '.join(applied))
+    else:
+        print('Схема БД актуальна')
+
+
+def seed_data(args):
+    if args.reset:
+        seed.reset()
+    user_ids = seed.seed(args.users, args.notes, args.tags_per_note, args.links_per_note, args.tag_vocabulary)
+    print(f'Создано пользователей: {len(user_ids)}, заметок: {len(user_ids) * args.notes}')
+
+
+def check_plans(args):
+    if args.seed:
+        seed.seed(args.users, args.notes, 3, 2)
+    problems, checked = plan_check.check_plans()
+    for sql, table in problems:
+        print(f'Последовательное чтение таблицы {table}:\n  {sql}')
+    print(f'Проверено запросов: {checked}, с последовательным чтением больших таблиц: {len(problems)}')
+    if problems:
+        sys.exit(1)
+
+
+def get_user_id(email):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(r"select id from users where email = %s;", (email,))
+    result = cursor.fetchone()
+    cursor.close()
+    put_db_connection(conn)
+    if result is None:
+        sys.exit(f'Нет пользователя с почтой {email}')
+    return result[0]
+
+
+def import_vault(args):
+    def progress(done, total):
+        print(f'Обработано файлов: {done} из {total}')
+
+    result = vault.import_vault(get_user_id(args.email), args.path, progress)
+    for name, message in result.errors:
+        print(f'{name} не импортирован: {message}')
+    print(f'Импортировано заметок: {result.imported}, не импортировано файлов: {len(result.errors)}')
+
+
+def export_vault(args):
+    with open(args.path, 'wb') as f:
+        for chunk in vault.export_vault(get_user_id(args.email)):
+            f.write(chunk)
+    print(f'Заметки сохранены в {args.path}')
+
+
+def add_seed_arguments(parser, users, notes):
+    parser.add_argument('--users', type=int, default=users, help='число пользователей')
+    parser.add_argument('--notes', type=int, default=notes, help='число заметок у каждого пользователя')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Служебные команды zettelkasten')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('backfill-links', help='заполнить note_links для существующих заметок') \
+        .set_defaults(func=backfill_links)
+
+    rerender_parser = subparsers.add_parser('rerender-notes', help='перерендерить HTML заметок')
+    rerender_parser.add_argument('--all', action='store_true', help='перерендерить все заметки, а не только устаревшие')
+    rerender_parser.set_defaults(func=rerender_notes)
+
+    subparsers.add_parser('sweep-tags', help='удалить теги, у которых не осталось заметок') \
+        .set_defaults(func=sweep_tags)
+
+    subparsers.add_parser('run-jobs', help='выполнить готовые фоновые задачи').set_defaults(func=run_jobs)
+
+    jobs_parser = subparsers.add_parser('jobs', help='состояние очереди фоновых задач')
+    jobs_parser.add_argument('--retry-failed', action='store_true', help='вернуть в очередь задачи, исчерпавшие попытки')
+    jobs_parser.set_defaults(func=show_jobs)
+
+    subparsers.add_parser('migrate', help='применить миграции схемы БД').set_defaults(func=run_migrations)
+
+    seed_parser = subparsers.add_parser('seed', help='создать синтетических пользователей и заметки')
+    add_seed_arguments(seed_parser, 10, 1000)
+    seed_parser.add_argument('--tags-per-note', type=int, default=3)
+    seed_parser.add_argument('--links-per-note', type=int, default=2)
+    seed_parser.add_argument('--tag-vocabulary', type=int, default=50, help='число тегов у каждого пользователя')
+    seed_parser.add_argument('--reset', action='store_true', help='удалить ранее созданные синтетические данные')
+    seed_parser.set_defaults(func=seed_data)
+
+    check_parser = subparsers.add_parser('check-plans',
+                                         help='проверить EXPLAIN запросов на последовательное чтение больших таблиц')
+    check_parser.add_argument('--seed', action='store_true', help='предварительно создать синтетические данные')
+    add_seed_arguments(check_parser, 20, 1000)
+    check_parser.set_defaults(func=check_plans)
+
+    import_parser = subparsers.add_parser('import-vault', help='импортировать заметки из каталога или zip-архива')
+    import_parser.add_argument('email', help='почта пользователя, которому добавляются заметки')
+    import_parser.add_argument('path', help='каталог или zip-архив с markdown-файлами')
+    import_parser.set_defaults(func=import_vault)
+
+    export_parser = subparsers.add_parser('export-vault', help='выгрузить заметки пользователя в zip-архив')
+    export_parser.add_argument('email')
+    export_parser.add_argument('path', help='файл архива')
+    export_parser.set_defaults(func=export_vault)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
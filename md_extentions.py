@@ -1,7 +1,13 @@
+import threading
+import time
+
+import markdown
 from markdown.inlinepatterns import InlineProcessor
 from markdown.extensions import Extension
 import xml.etree.ElementTree as etree
 
+import instrumentation
+
 
 class StrikeInlineProcessor(InlineProcessor):
     def handleMatch(self, m, data):
@@ -14,3 +20,31 @@ class StrikeExtension(Extension):
     def extendMarkdown(self, md):
         STRIKE_PATTERN = r'~~(.*?)~~'
         md.inlinePatterns.register(StrikeInlineProcessor(STRIKE_PATTERN, md), 'strike', 175)
+
+
+# Версия рендера: увеличить при изменении набора или настроек расширений,
+# после чего перерендерить заметки командой "python manage.py rerender-notes"
+RENDER_VERSION = f'1/{markdown.__version__}'
+
+_local = threading.local()
+
+
+def _get_markdown():
+    # Экземпляр Markdown не потокобезопасен, поэтому у каждого потока свой
+    md = getattr(_local, 'md', None)
+    if md is None:
+        md = markdown.Markdown(extensions=['fenced_code', StrikeExtension()])
+        _local.md = md
+    return md
+
+
+def render_markdown(text):
+    if instrumentation.ENABLED:
+        start = time.perf_counter()
+    md = _get_markdown()
+    try:
+        return md.convert(text or '')
+    finally:
+        md.reset()
+        if instrumentation.ENABLED:
+            instrumentation.record_render(time.perf_counter() - start)
@@ -0,0 +1,58 @@
+import logging
+import os
+
+from db import get_db_connection, put_db_connection
+
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Ключ advisory-блокировки: миграции не применяются одновременно из нескольких контейнеров
+MIGRATIONS_LOCK_KEY = 7_318_245_001
+
+
+def get_migrations():
+    """Возвращает [(версия, путь)] файлов migrations/NNNN_*.sql в порядке применения."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        if filename.endswith('.sql'):
+            migrations.append((filename[:-len('.sql')], os.path.join(MIGRATIONS_DIR, filename)))
+    return migrations
+
+
+def migrate():
+    """Применяет ещё не применённые миграции, каждую в своей транзакции. Возвращает их версии."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(r"select pg_advisory_lock(%s);", (MIGRATIONS_LOCK_KEY,))
+    applied_now = []
+    try:
+        cursor.execute(r"create table if not exists schema_migrations ("
+                       r"version varchar (200) primary key, "
+                       r"dt_applied timestamp not null default now());")
+        conn.commit()
+
+        cursor.execute(r"select version from schema_migrations;")
+        applied = {row[0] for row in cursor.fetchall()}
+
+        for version, path in get_migrations():
+            if version in applied:
+                continue
+            logger.info('Применение миграции %s', version)
+            with open(path, encoding='utf-8') as f:
+                cursor.execute(f.read())
+            cursor.execute(r"insert into schema_migrations (version) values (%s);", (version,))
+            conn.commit()
+            applied_now.append(version)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute(r"select pg_advisory_unlock(%s);", (MIGRATIONS_LOCK_KEY,))
+        conn.commit()
+        cursor.close()
+        put_db_connection(conn)
+
+    return applied_now
@@ -0,0 +1,42 @@
+-- Исходная схема. "if not exists", чтобы миграция применялась и к базам,
+-- созданным прежним init_db.sh
+create extension if not exists pgcrypto;
+
+create table if not exists users (
+  id serial primary key,
+  email varchar (320) not null unique,
+  password_hash text not null,
+  dt_added timestamp
+);
+
+create table if not exists notes (
+  id serial primary key,
+  user_id int
+      references users(id)
+      on delete cascade,
+  local_id int not null,
+  title varchar (200),
+  text varchar (3000),
+  dt_added timestamp not null,
+  dt_edited timestamp,
+  constraint note_constrain unique (user_id, local_id)
+);
+
+create table if not exists user_tags (
+  id serial primary key,
+  user_id int not null
+      references users(id)
+      on delete cascade,
+  tag varchar (50) not null,
+  constraint tag_constrain unique (user_id, tag)
+);
+
+create table if not exists note_tags (
+  id serial primary key,
+  tag_id int not null
+      references user_tags(id)
+      on delete cascade,
+  note_id int not null
+      references notes(id)
+      on delete cascade
+);
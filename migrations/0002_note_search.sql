@@ -0,0 +1,11 @@
+-- Полнотекстовый поиск (search.py) и нечёткий поиск по триграммам
+create extension if not exists pg_trgm;
+
+alter table notes add column if not exists search_vector tsvector generated always as (
+  setweight(to_tsvector('russian', coalesce(title, '')), 'A') ||
+  setweight(to_tsvector('russian', coalesce(text, '')), 'B')
+) stored;
+
+create index if not exists notes_search_idx on notes using gin (search_vector);
+create index if not exists notes_title_trgm_idx on notes using gin (title gin_trgm_ops);
+create index if not exists notes_text_trgm_idx on notes using gin (text gin_trgm_ops);
@@ -0,0 +1,21 @@
+-- Граф ссылок между заметками: [текст](local_id)
+create table if not exists note_links (
+  source_id int not null
+      references notes(id)
+      on delete cascade,
+  user_id int not null
+      references users(id)
+      on delete cascade,
+  target_local_id int not null,
+  primary key (source_id, target_local_id)
+);
+
+create index if not exists note_links_target_idx on note_links (user_id, target_local_id);
+
+-- Ссылки существующих заметок; то же регулярное выражение, что links.NOTE_LINK_RE.
+-- Номера больше links.MAX_LOCAL_ID не помещаются в int и пропускаются, как в links.extract_links
+insert into note_links (source_id, user_id, target_local_id)
+select id, user_id, m[1]::int
+from notes, regexp_matches(text, '\[[^\]]*\]\(([0-9]+)\)', 'g') m
+where m[1]::numeric <= 2147483647
+on conflict do nothing;
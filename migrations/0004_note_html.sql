@@ -0,0 +1,4 @@
+-- HTML заметки, отрендеренный при сохранении. Для существующих заметок он пуст
+-- и рендерится при чтении, пока не выполнена "python manage.py rerender-notes"
+alter table notes add column if not exists html text;
+alter table notes add column if not exists html_version varchar (50);
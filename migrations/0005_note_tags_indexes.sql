@@ -0,0 +1,15 @@
+-- Индексы для запросов по note_tags: выборка тегов заметок (note_id),
+-- заметок с тегом и подсчёт заметок тега (tag_id)
+delete from note_tags a
+using note_tags b
+where a.tag_id = b.tag_id and a.note_id = b.note_id and a.id > b.id;
+
+do $$
+begin
+  if not exists (select 1 from pg_constraint where conname = 'note_tag_constrain') then
+    alter table note_tags add constraint note_tag_constrain unique (tag_id, note_id);
+  end if;
+end
+$$;
+
+create index if not exists note_tags_note_id_idx on note_tags (note_id);
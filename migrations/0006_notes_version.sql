@@ -0,0 +1,4 @@
+-- Метка изменений заметок пользователя: увеличивается при каждом создании,
+-- изменении и удалении заметки. По ней считаются ETag и Last-Modified страниц
+alter table users add column if not exists notes_version bigint not null default 0;
+alter table users add column if not exists dt_notes_changed timestamptz not null default now();
@@ -0,0 +1,51 @@
+-- Число заметок с тегом поддерживается триггерами на note_tags, поэтому /tags
+-- читает готовые счётчики по индексу вместо группировки note_tags.
+-- Триггеры уровня оператора: COPY и массовые insert/delete обновляют каждый тег один раз.
+-- Строки note_tags только добавляются и удаляются, update к ним не применяется
+alter table user_tags add column if not exists note_count int not null default 0;
+
+update user_tags
+set note_count = counts.note_count
+from (select tag_id, count(*) note_count from note_tags group by tag_id) counts
+where user_tags.id = counts.tag_id and user_tags.note_count <> counts.note_count;
+
+create or replace function note_tags_count_insert() returns trigger as $$
+begin
+  -- Строки тегов блокируются в порядке id, чтобы параллельные транзакции
+  -- с пересекающимися тегами не блокировали друг друга взаимно
+  perform 1 from user_tags where id in (select tag_id from new_rows) order by id for update;
+  update user_tags
+  set note_count = user_tags.note_count + counts.n
+  from (select tag_id, count(*) n from new_rows group by tag_id) counts
+  where user_tags.id = counts.tag_id;
+  return null;
+end
+$$ language plpgsql;
+
+create or replace function note_tags_count_delete() returns trigger as $$
+begin
+  perform 1 from user_tags where id in (select tag_id from old_rows) order by id for update;
+  update user_tags
+  set note_count = user_tags.note_count - counts.n
+  from (select tag_id, count(*) n from old_rows group by tag_id) counts
+  where user_tags.id = counts.tag_id;
+  return null;
+end
+$$ language plpgsql;
+
+drop trigger if exists note_tags_count_insert on note_tags;
+create trigger note_tags_count_insert
+after insert on note_tags
+referencing new table as new_rows
+for each statement execute function note_tags_count_insert();
+
+drop trigger if exists note_tags_count_delete on note_tags;
+create trigger note_tags_count_delete
+after delete on note_tags
+referencing old table as old_rows
+for each statement execute function note_tags_count_delete();
+
+-- Страница /tags: теги пользователя по убыванию числа заметок
+create index if not exists user_tags_user_id_note_count_idx on user_tags (user_id, note_count desc, tag);
+-- Поиск неиспользуемых тегов для удаления (Tag.delete_unused_tags)
+create index if not exists user_tags_unused_idx on user_tags (id) where note_count = 0;
@@ -0,0 +1,9 @@
+-- Счётчик local_id заметок пользователя: Note.add_note выделяет номер одним update
+-- строки пользователя вместо max(local_id) + 1, на котором одновременные сохранения
+-- нарушали note_constrain. Удалённые номера больше не выдаются повторно
+alter table users add column if not exists last_note_local_id int not null default 0;
+
+update users
+set last_note_local_id = notes.max_local_id
+from (select user_id, max(local_id) max_local_id from notes group by user_id) notes
+where users.id = notes.user_id and users.last_note_local_id < notes.max_local_id;
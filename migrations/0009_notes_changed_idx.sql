@@ -0,0 +1,3 @@
+-- Заметки пользователя, созданные или изменённые после заданного времени: по ним модель
+-- похожих заметок (related.py) обновляется без чтения всех заметок пользователя
+create index if not exists notes_user_id_changed_idx on notes (user_id, (coalesce(dt_edited, dt_added)));
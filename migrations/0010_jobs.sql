@@ -0,0 +1,19 @@
+-- Очередь фоновых задач (jobs.py). Задача одного вида для одной заметки хранится одной
+-- строкой: повторная постановка увеличивает generation, и задача выполняется ещё раз,
+-- если заметка изменилась во время выполнения. Задачи удалённой заметки удаляются вместе с ней
+create table if not exists jobs (
+  id bigserial primary key,
+  kind varchar (50) not null,
+  note_id int not null
+      references notes(id)
+      on delete cascade,
+  generation int not null default 0,
+  attempts int not null default 0,
+  last_error text,
+  dt_added timestamptz not null default now(),
+  dt_run_after timestamptz not null default now(),
+  dt_locked timestamptz,
+  constraint job_constrain unique (kind, note_id)
+);
+
+create index if not exists jobs_dt_run_after_idx on jobs (dt_run_after, id);
@@ -0,0 +1,27 @@
+-- Версия изменений заметок пользователя (users.notes_version), в которой заметка создана
+-- или изменена. По ней модель похожих заметок (related.py) перечитывает изменившиеся
+-- заметки. Время создания заметки для этого не годится: импорт задаёт его из файлов.
+-- Каждая транзакция, меняющая заметки, сначала увеличивает notes_version под блокировкой
+-- строки пользователя, поэтому триггер видит уже увеличенную версию
+alter table notes add column if not exists change_version bigint not null default 0;
+
+update notes
+set change_version = users.notes_version
+from users
+where users.id = notes.user_id and notes.change_version <> users.notes_version;
+
+create or replace function notes_set_change_version() returns trigger as $$
+begin
+  new.change_version := (select notes_version from users where id = new.user_id);
+  return new;
+end
+$$ language plpgsql;
+
+-- HTML заметки меняет фоновая задача без изменения текста, на похожесть это не влияет
+drop trigger if exists notes_set_change_version on notes;
+create trigger notes_set_change_version
+before insert or update of title, text, dt_edited on notes
+for each row execute function notes_set_change_version();
+
+create index if not exists notes_user_id_change_version_idx on notes (user_id, change_version);
+drop index if exists notes_user_id_changed_idx;
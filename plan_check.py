@@ -0,0 +1,132 @@
+import json
+
+from psycopg2.extensions import cursor as base_cursor
+
+import config
+import db
+import graph
+import search
+import tag_query
+from db import User, Note, Tag
+from db_pool import ConnectionPool
+
+
+# Таблицы с таким числом строк и больше считаются большими: их последовательное
+# чтение в запросах приложения считается ошибкой
+LARGE_TABLE_ROWS = 5000
+
+_explained = []  # [(запрос, план)]
+
+
+class ExplainCursor(base_cursor):
+    """Курсор, выполняющий EXPLAIN для каждого читающего запроса перед самим запросом."""
+
+    def execute(self, query, vars=None):
+        sql = query.decode() if isinstance(query, bytes) else query
+        if sql.lstrip().lower().startswith(('select', 'with')):
+            # Серверный (именованный) курсор не выполняет EXPLAIN, план запрашивается обычным курсором
+            explain_cursor = self.connection.cursor(cursor_factory=base_cursor) if self.name is not None else self
+            base_cursor.execute(explain_cursor, 'explain (format json) ' + sql, vars)
+            plan = explain_cursor.fetchone()[0]
+            if explain_cursor is not self:
+                explain_cursor.close()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            _explained.append((sql, plan[0]['Plan']))
+        return super().execute(query, vars)
+
+
+def _seq_scans(plan):
+    scans = []
+    if plan.get('Node Type') == 'Seq Scan':
+        scans.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        scans.extend(_seq_scans(child))
+    return scans
+
+
+def _large_tables():
+    conn = db.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(r"select relname from pg_class "
+                   r"where relkind = 'r' and relnamespace = 'public'::regnamespace and reltuples >= %s;",
+                   (LARGE_TABLE_ROWS,))
+    tables = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    db.put_db_connection(conn)
+    return tables
+
+
+def _sample_user_id():
+    conn = db.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(r"select user_id from notes group by user_id order by count(*) desc limit 1;")
+    result = cursor.fetchone()
+    cursor.close()
+    db.put_db_connection(conn)
+    return result[0] if result else None
+
+
+def _run_queries(user_id):
+    """Вызывает читающие методы db.py и search.py на данных пользователя user_id."""
+    user = User.get_user(user_id)
+    User.is_email_used(user.email)
+
+    notes = list(Note.get_user_notes(user_id, 0, config.NOTES_PAGE_SIZE))
+    list(Note.get_user_notes(user_id, notes[-1].local_id, config.NOTES_PAGE_SIZE))
+    note = Note.get_note(user_id, notes[len(notes) // 2].local_id)
+    Note.get_notes_linked_to(user_id, note.local_id)
+    Note.get_notes_linked_from(note.id)
+    Tag.get_note_tags(note.id)
+    Tag.get_notes_tags([n.id for n in notes])
+    graph.note_graph(user_id, note.local_id, 2, tag_edges=True)
+
+    user_tags = Tag.get_user_tags(user_id)
+    if user_tags:
+        list(Note.get_notes_with_tag(user_id, user_tags[-1][0].id, 0, config.NOTES_PAGE_SIZE))
+    if len(user_tags) >= 3:
+        expression = tag_query.parse(' '.join((tag_query.quote(user_tags[0][0].tag_str), 'OR',
+                                               tag_query.quote(user_tags[-1][0].tag_str), 'NOT',
+                                               tag_query.quote(user_tags[1][0].tag_str))))
+        list(Note.get_notes_by_tag_query(user_id, expression, 0, config.NOTES_PAGE_SIZE))
+
+    word = note.title.split()[0]
+    search.search_notes(user_id, word, 1, config.NOTES_PAGE_SIZE)
+    search.search_notes(user_id, word[:-1] + 'ъ', 1, config.NOTES_PAGE_SIZE, fuzzy=True)
+
+
+def check_plans():
+    """Проверяет, что запросы приложения не читают большие таблицы последовательно.
+
+    Возвращает найденные последовательные чтения [(запрос, таблица)] и число проверенных запросов.
+    """
+    large_tables = _large_tables()
+    user_id = _sample_user_id()
+    if user_id is None:
+        raise RuntimeError('В базе нет заметок: сначала выполните "python manage.py seed"')
+
+    db.set_pool(ConnectionPool(
+        min_size=1,
+        max_size=1,
+        timeout=config.DB_POOL_TIMEOUT,
+        idle_timeout=config.DB_POOL_IDLE_TIMEOUT,
+        health_check_interval=config.DB_POOL_HEALTH_CHECK_INTERVAL,
+        host=config.DB_HOST,
+        port=config.DB_PORT,
+        database=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD,
+        cursor_factory=ExplainCursor
+    ))
+    _explained.clear()
+    try:
+        _run_queries(user_id)
+    finally:
+        db.close_pool()
+
+    problems = []
+    for sql, plan in _explained:
+        for table in _seq_scans(plan):
+            if table in large_tables:
+                problems.append((sql, table))
+    return problems, len(_explained)
@@ -0,0 +1,324 @@
+import logging
+import math
+import re
+import threading
+from array import array
+from collections import Counter
+
+import numpy as np
+
+import config
+import instrumentation
+from cache import LRUCache
+from db import get_db_connection, put_db_connection, User, Note
+
+
+# Похожие заметки для страницы заметки. Для каждого пользователя в памяти процесса
+# строится модель: векторы TF-IDF слов заголовка и текста и векторы тегов с весом IDF,
+# хранящиеся как обратные индексы из массивов numpy. Похожесть двух заметок - взвешенная
+# сумма косинусов их текстовых векторов и векторов тегов.
+# Модель обновляется по notes_version пользователя: все изменения заметок (в том числе
+# импорт и изменения в других процессах gunicorn) увеличивают её, и при следующем
+# запросе в модель перечитываются только изменившиеся заметки
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'[^\W\d_]{3,}')
+
+# Заголовок важнее текста: его слова считаются столько раз
+TITLE_WEIGHT = 2
+
+models = LRUCache(config.RELATED_CACHE_USERS, config.RELATED_CACHE_TTL)
+_builds = {}  # user_id -> поток, строящий модель
+_builds_lock = threading.Lock()
+_builds_total = 0
+_syncs_total = 0
+
+
+def _terms(title, text):
+    counts = Counter(_WORD_RE.findall((text or '').lower()))
+    for word in _WORD_RE.findall(title.lower()):
+        counts[word] += TITLE_WEIGHT
+    return counts
+
+
+class _FeatureIndex:
+    """Обратный индекс признак -> (строки модели, веса) для векторов одного вида.
+
+    Списки хранятся в array.array, а не в списках python: у пользователя с десятками
+    тысяч заметок в индексе миллионы пар (строка, вес).
+    """
+
+    def __init__(self, documents, max_df):
+        # IDF считается при построении модели и дальше не меняется: веса уже добавленных
+        # заметок остаются верными, а модель перестраивается, когда изменится заметная
+        # часть заметок. Признаки из большей доли заметок, чем max_df, не различают
+        # заметки и не хранятся
+        df = Counter()
+        for counts in documents:
+            df.update(counts.keys())
+        self.n = max(len(documents), 1)
+        self.ids = {}  # признак -> номер
+        self.idf = []
+        self.stop_features = set()
+        for feature, count in df.items():
+            if count > max_df * self.n:
+                self.stop_features.add(feature)
+            else:
+                self.ids[feature] = len(self.idf)
+                self.idf.append(math.log((1 + self.n) / (1 + count)) + 1)
+        self.postings = {}  # номер признака -> (array строк, array весов)
+        self.arrays = {}  # номер признака -> (массив строк, массив весов), пересобирается после изменений
+        self.row_vectors = []  # строка -> (массив номеров признаков, массив весов)
+        self.norms = []
+
+    def add(self, row, counts):
+        features = array('i')
+        weights = array('f')
+        for feature, count in counts.items():
+            if feature in self.stop_features:
+                continue
+            feature_id = self.ids.get(feature)
+            if feature_id is None:
+                feature_id = self.ids[feature] = len(self.idf)
+                self.idf.append(math.log(1 + self.n) + 1)
+            weight = (1 + math.log(count)) * self.idf[feature_id]
+            features.append(feature_id)
+            weights.append(weight)
+            posting = self.postings.get(feature_id)
+            if posting is None:
+                posting = self.postings[feature_id] = (array('i'), array('f'))
+            posting[0].append(row)
+            posting[1].append(weight)
+            self.arrays.pop(feature_id, None)
+        weights = np.array(weights, dtype=np.float32)
+        self.row_vectors.append((np.array(features, dtype=np.int32), weights))
+        self.norms.append(float(np.sqrt(np.dot(weights, weights))))
+
+    def dot(self, row, size):
+        """Скалярные произведения вектора строки row со всеми строками модели."""
+        scores = np.zeros(size)
+        for feature_id, weight in zip(*self.row_vectors[row]):
+            arrays = self.arrays.get(feature_id)
+            if arrays is None:
+                rows, values = self.postings[feature_id]
+                arrays = self.arrays[feature_id] = (np.array(rows, dtype=np.int32),
+                                                    np.array(values, dtype=np.float32))
+            # Строка входит в список признака один раз, поэтому индексы не повторяются
+            scores[arrays[0]] += weight * arrays[1]
+        return scores
+
+
+def _inverse(norms):
+    # У пустого вектора норма 0, а все его произведения тоже 0
+    norms = np.array(norms)
+    return np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+
+
+class RelatedModel:
+    """Модель похожих заметок одного пользователя."""
+
+    def __init__(self, user_id, version, rows, tags):
+        self.user_id = user_id
+        self.version = version
+        self.lock = threading.Lock()
+        self.rows = {}  # local_id -> строка модели
+        self.note_ids = []
+        self.local_ids = []
+        self.titles = []
+        self.alive = []
+        self.changed = 0
+        self._arrays = None
+        documents = [_terms(row[2], row[3]) for row in rows]
+        tag_documents = [Counter(tags.get(row[0], ())) for row in rows]
+        self.text = _FeatureIndex(documents, config.RELATED_MAX_DF)
+        self.tags = _FeatureIndex(tag_documents, 1)
+        for row, counts, tag_counts in zip(rows, documents, tag_documents):
+            self._add(row, counts, tag_counts)
+        self.changed = 0
+
+    def _add(self, row, counts, tag_counts):
+        note_id, local_id, title, _ = row
+        index = len(self.local_ids)
+        old = self.rows.get(local_id)
+        if old is not None:
+            self.alive[old] = False
+        self.rows[local_id] = index
+        self.note_ids.append(note_id)
+        self.local_ids.append(local_id)
+        self.titles.append(title)
+        self.alive.append(True)
+        self.text.add(index, counts)
+        self.tags.add(index, tag_counts)
+        self.changed += 1
+        self._arrays = None
+
+    def update(self, rows, tags, deleted_local_ids):
+        """Заменяет изменившиеся заметки rows и удаляет deleted_local_ids."""
+        for local_id in deleted_local_ids:
+            index = self.rows.pop(local_id, None)
+            if index is not None:
+                self.alive[index] = False
+                self.changed += 1
+        for row in rows:
+            self._add(row, _terms(row[2], row[3]), Counter(tags.get(row[0], ())))
+        self._arrays = None
+
+    @property
+    def stale(self):
+        # Удалённые и заменённые строки остаются в индексах, а IDF не пересчитывается,
+        # поэтому после большого числа изменений модель строится заново
+        return self.changed > config.RELATED_REBUILD_FRACTION * max(len(self.rows), 1)
+
+    def related(self, local_id, count):
+        """Возвращает [(local_id, похожесть)] count самых похожих заметок."""
+        index = self.rows.get(local_id)
+        if index is None:
+            return []
+        if self._arrays is None:
+            self._arrays = (np.array(self.alive), _inverse(self.text.norms), _inverse(self.tags.norms))
+        alive, text_norms, tag_norms = self._arrays
+        size = len(self.local_ids)
+        scores = np.zeros(size)
+        if self.text.norms[index] > 0:
+            scores += (1 - config.RELATED_TAG_WEIGHT) * self.text.dot(index, size) * text_norms / self.text.norms[index]
+        if self.tags.norms[index] > 0:
+            scores += config.RELATED_TAG_WEIGHT * self.tags.dot(index, size) * tag_norms / self.tags.norms[index]
+        scores[~alive] = 0
+        scores[index] = 0
+        count = min(count, size)
+        top = np.argpartition(-scores, count - 1)[:count] if count > 0 else []
+        top = sorted((i for i in top if scores[i] > 0), key=lambda i: (-scores[i], self.local_ids[i]))
+        return [(self.local_ids[i], float(scores[i])) for i in top]
+
+
+def _read_notes(cursor, user_id, local_ids=None):
+    query = r"select id, local_id, title, text " \
+            r"from notes " \
+            r"where user_id = %s and (%s::int[] is null or local_id = any(%s));"
+    cursor.execute(query, (user_id, local_ids, local_ids))
+    rows = cursor.fetchall()
+    query = r"select note_tags.note_id, user_tags.tag " \
+            r"from note_tags " \
+            r"join user_tags on user_tags.id = note_tags.tag_id " \
+            r"where user_tags.user_id = %s and (%s::int[] is null or note_tags.note_id = any(%s));"
+    note_ids = None if local_ids is None else [row[0] for row in rows]
+    cursor.execute(query, (user_id, note_ids, note_ids))
+    tags = {}
+    for note_id, tag in cursor.fetchall():
+        tags.setdefault(note_id, []).append(tag)
+    return rows, tags
+
+
+def _build(user_id, version):
+    # version считана до чтения заметок: изменения во время построения
+    # подхватит следующая синхронизация
+    global _builds_total
+    try:
+        conn = get_db_connection(read_only=True)
+        cursor = conn.cursor()
+        try:
+            rows, tags = _read_notes(cursor, user_id)
+        finally:
+            # Соединение возвращается в пул и при ошибке: putconn откатывает транзакцию
+            cursor.close()
+            put_db_connection(conn)
+
+        models.set(str(user_id), RelatedModel(user_id, version, rows, tags))
+    except Exception:
+        logger.exception('Не удалось построить модель похожих заметок пользователя %s', user_id)
+    finally:
+        with _builds_lock:
+            _builds.pop(user_id, None)
+            _builds_total += 1
+
+
+def _start_build(user_id, version):
+    # Одна модель пользователя строится одновременно не больше одного раза
+    with _builds_lock:
+        thread = _builds.get(user_id)
+        if thread is None:
+            thread = _builds[user_id] = threading.Thread(target=_build, args=(user_id, version),
+                                                         name='related-build', daemon=True)
+            thread.start()
+    return thread
+
+
+def _sync(model, version):
+    """Перечитывает в модель заметки, изменившиеся после её построения или прошлой синхронизации."""
+    global _syncs_total
+    conn = get_db_connection(read_only=True)
+    cursor = conn.cursor()
+
+    # change_version заметки - notes_version транзакции, которая её создала или изменила
+    # (миграция 0011), поэтому сюда попадают и импортированные заметки с давней датой создания
+    query = r"select local_id from notes " \
+            r"where user_id = %s and change_version > %s;"
+    cursor.execute(query, (model.user_id, model.version))
+    changed = [row[0] for row in cursor.fetchall()]
+    rows, tags = _read_notes(cursor, model.user_id, changed) if changed else ([], {})
+
+    # Удалённые заметки ищутся, только если их число не сходится с числом заметок в БД
+    cursor.execute(r"select count(*) from notes where user_id = %s;", (model.user_id,))
+    count = cursor.fetchone()[0]
+    deleted = []
+    if count != len(model.rows.keys() | {row[1] for row in rows}):
+        cursor.execute(r"select local_id from notes where user_id = %s;", (model.user_id,))
+        existing = {row[0] for row in cursor.fetchall()}
+        deleted = [local_id for local_id in model.rows if local_id not in existing]
+
+    cursor.close()
+    put_db_connection(conn)
+
+    model.update(rows, tags, deleted)
+    model.version = version
+    with _builds_lock:
+        _syncs_total += 1
+
+
+def _get_model(user_id, stamp):
+    model = models.get(str(user_id))
+    if model is None:
+        # Модель строится в фоне, а страница пока показывается без похожих заметок
+        _start_build(user_id, stamp.version)
+        return None
+
+    with model.lock:
+        if model.version != stamp.version:
+            _sync(model, stamp.version)
+    if model.stale:
+        # До конца перестроения используется прежняя модель
+        _start_build(user_id, stamp.version)
+    return model
+
+
+def get_related_notes(user_id, note_local_id, count=None, stamp=None):
+    """Возвращает до count заметок, похожих на заметку note_local_id, от самой похожей.
+
+    stamp - метка изменений заметок пользователя, если она уже прочитана. None - модель
+    пользователя ещё строится.
+    """
+    if stamp is None:
+        stamp = User.get_notes_stamp(user_id)
+        if stamp is None:
+            return None
+    model = _get_model(user_id, stamp)
+    if model is None:
+        return None
+    with model.lock:
+        related = model.related(note_local_id, count or config.RELATED_NOTES_COUNT)
+        return [Note(model.note_ids[model.rows[local_id]], user_id, local_id,
+                     model.titles[model.rows[local_id]], None, None, None, set())
+                for local_id, _ in related]
+
+
+def _metrics():
+    metrics = {f'related_models_{name}': value for name, value in models.get_stats().items()}
+    with _builds_lock:
+        metrics['related_builds_total'] = _builds_total
+        metrics['related_syncs_total'] = _syncs_total
+    return metrics
+
+
+def init_app(app):
+    instrumentation.metrics_sources.append(_metrics)
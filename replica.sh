@@ -0,0 +1,16 @@
+#!/bin/bash
+set -e
+
+# Реплика только для чтения: при первом запуске копирует данные основного сервера
+# и дальше получает от него WAL потоковой репликацией (standby.signal и
+# primary_conninfo создаёт pg_basebackup -R)
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+  until pg_isready --host "$PRIMARY_HOST" --quiet; do
+    sleep 1
+  done
+  PGPASSWORD="$REPLICATION_PASSWORD" pg_basebackup --host "$PRIMARY_HOST" --username replicator \
+    --pgdata "$PGDATA" --write-recovery-conf --wal-method stream
+  chmod 700 "$PGDATA"
+fi
+
+exec postgres
@@ -0,0 +1,93 @@
+from collections import namedtuple
+
+from markupsafe import Markup, escape
+
+from db import get_db_connection, put_db_connection, Note, Tag
+
+
+# Конфигурация russian стеммит кириллицу русским, а латиницу английским стеммером,
+# поэтому одной конфигурации хватает для заметок на обоих языках
+TS_CONFIG = 'russian'
+
+# Маркеры подсветки в ts_headline: текст заметки экранируется уже после подсветки,
+# поэтому используем символы, которых нет в обычном тексте, а не HTML-теги
+_START_SEL = '\x02'
+_STOP_SEL = '\x03'
+HEADLINE_OPTIONS = f'StartSel={_START_SEL}, StopSel={_STOP_SEL}, MaxWords=30, MinWords=10, MaxFragments=2'
+
+FUZZY_SNIPPET_LENGTH = 200
+
+
+SearchPage = namedtuple('SearchPage', ['notes', 'snippets', 'has_next', 'fuzzy'])
+
+
+def _highlight(snippet):
+    snippet = str(escape(snippet))
+    snippet = snippet.replace(_START_SEL, '<mark>').replace(_STOP_SEL, '</mark>')
+    return Markup(snippet)
+
+
+def _fulltext_search(cursor, user_id, search_query, limit, offset):
+    # ts_headline дорогой, поэтому считаем его только для заметок текущей страницы
+    query = r"select id, user_id, local_id, title, dt_added, dt_edited, " \
+            r"ts_headline(%s, coalesce(text, ''), query, %s) " \
+            r"from (" \
+            r"select id, user_id, local_id, title, text, dt_added, dt_edited, query, " \
+            r"ts_rank_cd(search_vector, query) as rank " \
+            r"from notes, websearch_to_tsquery(%s, %s) query " \
+            r"where user_id = %s and search_vector @@ query " \
+            r"order by rank desc, local_id " \
+            r"limit %s offset %s" \
+            r") page " \
+            r"order by rank desc, local_id;"
+    cursor.execute(query, (TS_CONFIG, HEADLINE_OPTIONS, TS_CONFIG, search_query, user_id, limit, offset))
+    return cursor.fetchall()
+
+
+def _fuzzy_search(cursor, user_id, search_query, limit, offset):
+    # Поиск по триграммам (pg_trgm) находит заметки и при опечатках в запросе
+    query = r"select id, user_id, local_id, title, dt_added, dt_edited, left(text, %s) " \
+            r"from notes " \
+            r"where user_id = %s and (title %% %s or %s <%% text) " \
+            r"order by greatest(similarity(title, %s), word_similarity(%s, text)) desc, local_id " \
+            r"limit %s offset %s;"
+    cursor.execute(query, (FUZZY_SNIPPET_LENGTH, user_id, search_query, search_query,
+                           search_query, search_query, limit, offset))
+    return cursor.fetchall()
+
+
+def search_notes(user_id, search_query, page, page_size, fuzzy=False):
+    """Ищет заметки пользователя, отсортированные по релевантности.
+
+    Если полнотекстовый поиск ничего не нашёл, выполняется нечёткий поиск
+    по триграммам; следующие страницы такого поиска запрашиваются с fuzzy=True.
+    Возвращает SearchPage с заметками страницы page (с 1), подсвеченными
+    фрагментами текста по id заметки и признаком следующей страницы.
+    """
+    conn = get_db_connection(read_only=True)
+    cursor = conn.cursor()
+
+    offset = (page - 1) * page_size
+    # Запрашиваем на одну заметку больше, чтобы узнать, есть ли следующая страница
+    if fuzzy:
+        result = _fuzzy_search(cursor, user_id, search_query, page_size + 1, offset)
+    else:
+        result = _fulltext_search(cursor, user_id, search_query, page_size + 1, offset)
+        if len(result) == 0 and page == 1:
+            result = _fuzzy_search(cursor, user_id, search_query, page_size + 1, offset)
+            fuzzy = True
+
+    has_next = len(result) > page_size
+    result = result[:page_size]
+
+    notes_tags = Tag.get_notes_tags([row[0] for row in result], conn_curs=(conn, cursor))
+    notes = []
+    snippets = {}
+    for row in result:
+        notes.append(Note(row[0], row[1], row[2], row[3], None, row[4], row[5], notes_tags[row[0]]))
+        snippets[row[0]] = _highlight(row[6])
+
+    cursor.close()
+    put_db_connection(conn)
+
+    return SearchPage(notes, snippets, has_next, fuzzy)
@@ -0,0 +1,146 @@
+import random
+from datetime import datetime, timedelta
+
+from db import get_db_connection, put_db_connection, copy_rows
+from md_extentions import RENDER_VERSION, render_markdown
+
+
+# Синтетические данные для проверки планов запросов и нагрузочных тестов.
+# Все пользователи создаются с почтой на этом домене и паролем SEED_PASSWORD
+SEED_EMAIL_DOMAIN = 'seed.example.com'
+SEED_PASSWORD = 'password'
+
+WORDS = (
+    'заметка', 'идея', 'связь', 'мысль', 'источник', 'цитата', 'вывод', 'вопрос', 'пример', 'метод',
+    'картотека', 'система', 'знание', 'контекст', 'аргумент', 'гипотеза', 'модель', 'память', 'текст',
+    'note', 'idea', 'link', 'thought', 'source', 'quote', 'question', 'example', 'method', 'system',
+    'knowledge', 'context', 'argument', 'model', 'memory', 'database', 'index', 'query', 'python',
+    'postgres', 'search', 'graph', 'reading', 'writing', 'research', 'concept', 'structure',
+)
+TAG_WORDS = (
+    'python', 'postgres', 'flask', 'черновик', 'идеи', 'книги', 'статьи', 'работа', 'учёба', 'проекты',
+    'математика', 'история', 'философия', 'программирование', 'базы данных', 'алгоритмы', 'заметки',
+    'todo', 'reading', 'research', 'draft', 'archive', 'people', 'meetings', 'health', 'finance',
+)
+
+MAX_TEXT_LENGTH = 3000
+
+
+def seed_email(n):
+    return f'seed-{n}@{SEED_EMAIL_DOMAIN}'
+
+
+def _sentence(rng, min_words=5, max_words=15):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def _markdown_body(rng, links):
+    """Текст заметки в markdown с заголовками, списками, кодом и ссылками на заметки links."""
+    blocks = []
+    links = list(links)
+    for _ in range(rng.randint(2, 6)):
+        kind = rng.random()
+        if kind < 0.15:
+            blocks.append('## ' + _sentence(rng, 2, 5)[:-1])
+        elif kind < 0.3:
+            blocks.append('\n'.join('- ' + _sentence(rng, 3, 8) for _ in range(rng.randint(2, 5))))
+        elif kind < 0.38:
+            blocks.append('```\nselect * from notes where id = %d;\n```' % rng.randint(1, 1000))
+        else:
+            sentences = [_sentence(rng) for _ in range(rng.randint(2, 5))]
+            if rng.random() < 0.3:
+                sentences.append(f'**{rng.choice(WORDS)}** и ~~{rng.choice(WORDS)}~~.')
+            if links:
+                target = links.pop()
+                sentences.append(f'См. [{rng.choice(WORDS)}]({target}).')
+            blocks.append(' '.join(sentences))
+    for target in links:
+        blocks.append(f'См. также [{rng.choice(WORDS)}]({target}).')
+    return '\n\n'.join(blocks)[:MAX_TEXT_LENGTH]
+
+
+def reset():
+    """Удаляет всех синтетических пользователей вместе с их заметками и тегами."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(r"delete from users where email like %s;", ('%@' + SEED_EMAIL_DOMAIN,))
+    conn.commit()
+    cursor.close()
+    put_db_connection(conn)
+
+
+def seed(users, notes_per_user, tags_per_note, links_per_note, tag_vocabulary=50, random_seed=0):
+    """Создаёт users пользователей по notes_per_user заметок с тегами и ссылками между заметками.
+
+    Возвращает список id созданных пользователей.
+    """
+    rng = random.Random(random_seed)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(r"select coalesce(max(split_part(split_part(email, '@', 1), '-', 2)::int), 0) "
+                   r"from users where email like %s;", ('%@' + SEED_EMAIL_DOMAIN,))
+    first = cursor.fetchone()[0] + 1
+
+    # Хеш пароля считается один раз: bcrypt для каждого пользователя слишком медленный
+    cursor.execute(r"select crypt(%s, gen_salt('bf'));", (SEED_PASSWORD,))
+    password_hash = cursor.fetchone()[0]
+    # Заметки загружаются с local_id 1..notes_per_user, счётчик пользователя указывает на последний
+    query = r"insert into users (email, password_hash, dt_added, last_note_local_id) " \
+            r"select 'seed-' || n || '@' || %s, %s, now(), %s " \
+            r"from generate_series(%s, %s) n " \
+            r"returning id;"
+    cursor.execute(query, (SEED_EMAIL_DOMAIN, password_hash, notes_per_user, first, first + users - 1))
+    user_ids = sorted(row[0] for row in cursor.fetchall())
+
+    start_dt = datetime.now() - timedelta(days=365)
+    note_rows = []
+    links = []
+    for user_id in user_ids:
+        for local_id in range(1, notes_per_user + 1):
+            targets = set()
+            if notes_per_user > 1:
+                for _ in range(links_per_note):
+                    target = rng.randint(1, notes_per_user)
+                    if target != local_id:
+                        targets.add(target)
+            text = _markdown_body(rng, sorted(targets))
+            dt_added = start_dt + timedelta(minutes=local_id * 10)
+            title = _sentence(rng, 2, 6)[:-1][:200]
+            note_rows.append((user_id, local_id, title, text, render_markdown(text), RENDER_VERSION, dt_added))
+            links.extend((user_id, local_id, target) for target in targets)
+    copy_rows(cursor, 'notes', ('user_id', 'local_id', 'title', 'text', 'html', 'html_version', 'dt_added'), note_rows)
+
+    cursor.execute(r"select id, user_id, local_id from notes where user_id = any(%s);", (user_ids,))
+    note_ids = {(row[1], row[2]): row[0] for row in cursor.fetchall()}
+
+    copy_rows(cursor, 'note_links', ('source_id', 'user_id', 'target_local_id'),
+          [(note_ids[(user_id, local_id)], user_id, target) for user_id, local_id, target in links])
+
+    tag_names = [TAG_WORDS[i % len(TAG_WORDS)] + ('' if i < len(TAG_WORDS) else f'-{i // len(TAG_WORDS)}')
+                 for i in range(tag_vocabulary)]
+    copy_rows(cursor, 'user_tags', ('user_id', 'tag'),
+          [(user_id, tag) for user_id in user_ids for tag in tag_names])
+    cursor.execute(r"select id, user_id from user_tags where user_id = any(%s) order by id;", (user_ids,))
+    user_tag_ids = {}
+    for tag_id, user_id in cursor.fetchall():
+        user_tag_ids.setdefault(user_id, []).append(tag_id)
+
+    # Популярность тегов убывает как у реальных пользователей: немногие теги на большинстве заметок
+    weights = [1 / (rank + 1) for rank in range(tag_vocabulary)]
+    note_tag_rows = []
+    for (user_id, local_id), note_id in note_ids.items():
+        tag_ids = set(rng.choices(user_tag_ids[user_id], weights=weights, k=min(tags_per_note, tag_vocabulary)))
+        note_tag_rows.extend((tag_id, note_id) for tag_id in tag_ids)
+    copy_rows(cursor, 'note_tags', ('tag_id', 'note_id'), note_tag_rows)
+
+    conn.commit()
+    conn.autocommit = True
+    cursor.execute(r"analyze;")
+    conn.autocommit = False
+
+    cursor.close()
+    put_db_connection(conn)
+
+    return user_ids
@@ -25,3 +25,120 @@ function tagsValidation(input) {
     input.setCustomValidity('');
   }
 }
+
+// Подсказки при вводе: для поля с data-autocomplete="tags" - теги по текущей строке,
+// для data-autocomplete="notes" - ссылки на заметки по тексту после "[["
+(function () {
+  'use strict'
+
+  var DELAY = 100
+
+  function currentQuery(input) {
+    var before = input.value.slice(0, input.selectionStart)
+    if (input.dataset.autocomplete === 'tags') {
+      var line = before.slice(before.lastIndexOf('\n') + 1)
+      return {start: before.length - line.length, query: line}
+    }
+    var match = /\[\[([^\[\]\n]*)$/.exec(before)
+    return match && match[1].trim() ? {start: match.index, query: match[1]} : null
+  }
+
+  function setup(input) {
+    var list = document.createElement('div')
+    list.className = 'list-group position-absolute shadow-sm d-none'
+    list.style.zIndex = 1000
+    input.parentNode.classList.add('position-relative')
+    input.insertAdjacentElement('afterend', list)
+
+    var timer = null
+    var controller = null
+    var items = []
+    var active = -1
+
+    function close() {
+      list.classList.add('d-none')
+      items = []
+      active = -1
+    }
+
+    function choose(item) {
+      var current = currentQuery(input)
+      if (current === null) {
+        return close()
+      }
+      var end = input.selectionStart
+      var value = input.dataset.autocomplete === 'tags' ? item.tag : item.link
+      input.value = input.value.slice(0, current.start) + value + input.value.slice(end)
+      input.selectionStart = input.selectionEnd = current.start + value.length
+      // Проверка поля тегов выполняется по событию input, новые подсказки после выбора не нужны
+      input.dispatchEvent(new Event('input'))
+      clearTimeout(timer)
+      close()
+      input.focus()
+    }
+
+    function highlight(index) {
+      active = index
+      Array.prototype.forEach.call(list.children, function (element, i) {
+        element.classList.toggle('active', i === active)
+      })
+    }
+
+    function show(result) {
+      items = result
+      list.innerHTML = ''
+      items.forEach(function (item) {
+        var element = document.createElement('button')
+        element.type = 'button'
+        element.className = 'list-group-item list-group-item-action py-1'
+        element.textContent = input.dataset.autocomplete === 'tags' ? item.tag + ' (' + item.count + ')' : item.title
+        // mousedown срабатывает раньше blur поля
+        element.addEventListener('mousedown', function (event) {
+          event.preventDefault()
+          choose(item)
+        })
+        list.appendChild(element)
+      })
+      list.classList.toggle('d-none', items.length === 0)
+      highlight(-1)
+    }
+
+    function request() {
+      var current = currentQuery(input)
+      if (controller !== null) {
+        controller.abort()
+      }
+      if (current === null || !current.query.trim()) {
+        return close()
+      }
+      controller = new AbortController()
+      fetch(input.dataset.autocompleteUrl + '?q=' + encodeURIComponent(current.query), {signal: controller.signal})
+        .then(function (response) { return response.ok ? response.json() : [] })
+        .then(show)
+        .catch(function () {})
+    }
+
+    input.addEventListener('input', function () {
+      clearTimeout(timer)
+      timer = setTimeout(request, DELAY)
+    })
+    input.addEventListener('keydown', function (event) {
+      if (items.length === 0) {
+        return
+      }
+      if (event.key === 'ArrowDown' || event.key === 'ArrowUp') {
+        var step = event.key === 'ArrowDown' ? 1 : -1
+        highlight((active + 1 + step + items.length + 1) % (items.length + 1) - 1)
+        event.preventDefault()
+      } else if ((event.key === 'Enter' || event.key === 'Tab') && active >= 0) {
+        choose(items[active])
+        event.preventDefault()
+      } else if (event.key === 'Escape') {
+        close()
+      }
+    })
+    input.addEventListener('blur', close)
+  }
+
+  Array.prototype.slice.call(document.querySelectorAll('[data-autocomplete]')).forEach(setup)
+})()
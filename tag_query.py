@@ -0,0 +1,156 @@
+import re
+
+
+# Выражения над тегами для фильтра /notes?tq=...: python AND (postgres OR sql) AND NOT черновик.
+# Операторы AND, OR, NOT (или И, ИЛИ, НЕ) и скобки; два тега подряд без оператора - AND.
+# Теги с пробелами, скобками или совпадающие с оператором записываются в кавычках: "базы данных"
+
+MAX_TERMS = 20
+# Глубина вложенности скобок и NOT: парсер рекурсивный, а выражение приходит от пользователя
+MAX_DEPTH = 10
+
+_OPERATORS = {
+    'and': 'and', 'и': 'and',
+    'or': 'or', 'или': 'or',
+    'not': 'not', 'не': 'not',
+}
+
+_TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+class TagQueryError(ValueError):
+    pass
+
+
+def quote(tag):
+    """Записывает тег как выражение из одного тега."""
+    if re.fullmatch(r'[^\s()"\\]+', tag) and tag.lower() not in _OPERATORS:
+        return tag
+    return '"' + tag.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN_RE.match(text, position)
+        if match is None:
+            raise TagQueryError('Незакрытая кавычка в выражении тегов')
+        position = match.end()
+        if match.group(1):
+            tokens.append(('(', None))
+        elif match.group(2):
+            tokens.append((')', None))
+        elif match.group(3) is not None:
+            tokens.append(('tag', re.sub(r'\\(.)', r'\1', match.group(3))))
+        elif match.group(4).lower() in _OPERATORS:
+            tokens.append((_OPERATORS[match.group(4).lower()], None))
+        else:
+            tokens.append(('tag', match.group(4)))
+    return tokens
+
+
+class _Parser:
+    # Рекурсивный спуск; приоритет операторов: NOT, затем AND, затем OR
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+        self.terms = 0
+        self.depth = 0
+
+    def peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def nest(self, step):
+        self.depth += step
+        if self.depth > MAX_DEPTH:
+            raise TagQueryError(f'Вложенность выражения тегов больше {MAX_DEPTH}')
+
+    def take(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise TagQueryError('Пустое выражение тегов')
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise TagQueryError('Лишняя закрывающая скобка в выражении тегов')
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == 'or':
+            self.take()
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.peek() in ('and', 'not', 'tag', '('):
+            if self.peek() == 'and':
+                self.take()
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not(self):
+        if self.peek() == 'not':
+            self.take()
+            self.nest(1)
+            node = self.parse_not()
+            self.nest(-1)
+            return 'not', node
+        return self.parse_atom()
+
+    def parse_atom(self):
+        kind = self.peek()
+        if kind == '(':
+            self.take()
+            self.nest(1)
+            node = self.parse_or()
+            if self.peek() != ')':
+                raise TagQueryError('Незакрытая скобка в выражении тегов')
+            self.take()
+            self.nest(-1)
+            return node
+        if kind == 'tag':
+            self.terms += 1
+            if self.terms > MAX_TERMS:
+                raise TagQueryError(f'В выражении больше {MAX_TERMS} тегов')
+            return 'tag', self.take()[1]
+        if kind is None:
+            raise TagQueryError('Выражение тегов обрывается после оператора')
+        raise TagQueryError('Ожидался тег или открывающая скобка')
+
+
+def parse(text):
+    """Разбирает выражение в дерево: ('tag', тег), ('not', узел), ('and'|'or', [узлы])."""
+    return _Parser(_tokenize(text)).parse()
+
+
+def compile_sql(node, user_id, placeholder):
+    """Возвращает (условие на notes.id, параметры) для дерева выражения.
+
+    Каждый тег - подзапрос множества заметок с тегом по индексам tag_constrain
+    и note_tag_constrain; планировщик объединяет их полусоединениями или
+    хеширует, поэтому выражение выполняется одним запросом.
+    placeholder() возвращает очередной параметр запроса: %s для psycopg2, $n для asyncpg.
+    """
+    kind = node[0]
+    if kind == 'tag':
+        sql = r"notes.id in (select note_tags.note_id from note_tags " \
+              r"join user_tags on user_tags.id = note_tags.tag_id " \
+              r"where user_tags.user_id = " + placeholder() + r" and user_tags.tag = " + placeholder() + r")"
+        return sql, [user_id, node[1]]
+    if kind == 'not':
+        sql, params = compile_sql(node[1], user_id, placeholder)
+        return r"not (" + sql + r")", params
+    parts = []
+    params = []
+    for child in node[1]:
+        sql, child_params = compile_sql(child, user_id, placeholder)
+        parts.append(sql)
+        params.extend(child_params)
+    return r"(" + (r" and " if kind == 'and' else r" or ").join(parts) + r")", params
@@ -0,0 +1,67 @@
+import logging
+import os
+import threading
+
+import config
+import instrumentation
+from db import Tag
+
+
+# Фоновое удаление тегов, у которых не осталось заметок. Поток запускается в каждом
+# воркере gunicorn; одновременные удаления не мешают друг другу благодаря skip locked
+
+logger = logging.getLogger(__name__)
+
+_thread = None
+_thread_pid = None
+_stop = threading.Event()
+_lock = threading.Lock()
+_deleted_total = 0
+
+
+def sweep():
+    global _deleted_total
+    deleted = Tag.delete_unused_tags(config.TAG_SWEEP_BATCH_SIZE)
+    with _lock:
+        _deleted_total += deleted
+    if deleted > 0:
+        logger.info('Удалено неиспользуемых тегов: %s', deleted)
+    return deleted
+
+
+def _run():
+    while not _stop.wait(config.TAG_SWEEP_INTERVAL):
+        try:
+            sweep()
+        except Exception:
+            logger.exception('Ошибка удаления неиспользуемых тегов')
+
+
+def start():
+    # Поток не переживает fork, поэтому запускается в каждом процессе отдельно
+    global _thread, _thread_pid
+    if config.TAG_SWEEP_INTERVAL <= 0:
+        return
+    with _lock:
+        if _thread is None or _thread_pid != os.getpid():
+            _stop.clear()
+            _thread = threading.Thread(target=_run, name='tag-sweep', daemon=True)
+            _thread.start()
+            _thread_pid = os.getpid()
+
+
+def stop():
+    global _thread, _thread_pid
+    _stop.set()
+    with _lock:
+        _thread = None
+        _thread_pid = None
+
+
+def _metrics():
+    with _lock:
+        return {'tag_sweep_deleted_total': _deleted_total}
+
+
+def init_app(app):
+    instrumentation.metrics_sources.append(_metrics)
@@ -0,0 +1,369 @@
+import io
+import json
+import os
+import re
+import zipfile
+from collections import namedtuple
+from datetime import datetime
+from urllib.parse import unquote
+
+from db import get_db_connection, put_db_connection, copy_rows, User
+from links import NOTE_LINK_RE, extract_links
+from md_extentions import RENDER_VERSION, render_markdown
+
+
+# Импорт и экспорт заметок пользователя в виде markdown-файлов с front matter
+# (формат хранилищ Obsidian): один файл - одна заметка, теги в поле tags
+
+BATCH_SIZE = 1000
+
+MAX_TITLE_LENGTH = 200
+MAX_TEXT_LENGTH = 3000
+MAX_TAG_LENGTH = 50
+# Файлы больше этого не читаются: текст всё равно не поместится в notes.text
+MAX_FILE_SIZE = 64 * 1024
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown')
+
+# Максимальная длина заголовка в имени файла экспорта
+FILENAME_TITLE_LENGTH = 100
+# Даты, которые можно записать в zip-архив: импорт принимает и более ранние
+ZIP_MIN_DATE = datetime(1980, 1, 1)
+ZIP_MAX_DATE = datetime(2107, 12, 31, 23, 59, 58)
+
+ImportResult = namedtuple('ImportResult', ['imported', 'errors'])
+
+_Entry = namedtuple('_Entry', ['name', 'size', 'mtime', 'read'])
+
+_FRONT_MATTER_RE = re.compile(r'\A---[ \t]*\r?\n(.*?)\r?\n---[ \t]*(?:\r?\n|\Z)', re.DOTALL)
+_LIST_ITEM_RE = re.compile(r'\s*-\s+(.*)')
+# [[заметка]], [[папка/заметка#раздел|текст ссылки]]
+_WIKI_LINK_RE = re.compile(r'\[\[([^\]|#]+)(?:#[^\]|]*)?(?:\|([^\]]+))?\]\]')
+# [текст](заметка.md), в том числе с путём и %20 в имени
+_FILE_LINK_RE = re.compile(r'\[([^\]]*)\]\(([^)\s]+\.(?:md|markdown))\)', re.IGNORECASE)
+_FILENAME_UNSAFE_RE = re.compile(r'[\\/:*?"<>|#^\[\]()\s]+')
+
+
+def _is_hidden(path):
+    # Служебные каталоги хранилищ (.obsidian, .trash) и архиваторов (__MACOSX)
+    return any(part.startswith('.') or part == '__MACOSX' for part in path.split('/'))
+
+
+def _zip_mtime(info):
+    # Архиваторы пишут нулевую дату DOS как (1980, 0, 0, 0, 0, 0): у такого файла даты нет
+    try:
+        return datetime(*info.date_time)
+    except ValueError:
+        return datetime.now()
+
+
+def _zip_entries(archive):
+    for info in archive.infolist():
+        if info.is_dir() or _is_hidden(info.filename) or not info.filename.lower().endswith(MARKDOWN_EXTENSIONS):
+            continue
+        yield _Entry(info.filename, info.file_size, _zip_mtime(info),
+                     lambda info=info: archive.read(info))
+
+
+def _dir_entries(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(MARKDOWN_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+
+            def read(path=path):
+                with open(path, 'rb') as f:
+                    return f.read()
+
+            yield _Entry(os.path.relpath(path, root).replace(os.sep, '/'), stat.st_size,
+                         datetime.fromtimestamp(stat.st_mtime), read)
+
+
+def _name_key(path):
+    # Obsidian находит заметку по имени файла без пути и расширения
+    name = path.rsplit('/', 1)[-1]
+    if name.lower().endswith(MARKDOWN_EXTENSIONS):
+        name = name.rsplit('.', 1)[0]
+    return name.strip().lower()
+
+
+def _scalar(value):
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        if value[0] == '"':
+            try:
+                return json.loads(value)
+            except ValueError:
+                pass
+        return value[1:-1]
+    return value
+
+
+def parse_front_matter(text):
+    """Возвращает (поля front matter, текст без него).
+
+    Поддерживается подмножество YAML из хранилищ заметок: строки "ключ: значение",
+    списки [a, b] и списки из строк "- элемент" под ключом.
+    """
+    match = _FRONT_MATTER_RE.match(text)
+    if match is None:
+        return {}, text
+
+    fields = {}
+    key = None
+    for line in match.group(1).splitlines():
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        item = _LIST_ITEM_RE.match(line)
+        if item is not None and key is not None:
+            if not isinstance(fields.get(key), list):
+                fields[key] = []
+            fields[key].append(_scalar(item.group(1)))
+            continue
+        key, sep, value = line.partition(':')
+        if not sep:
+            key = None
+            continue
+        key = key.strip().lower()
+        value = value.strip()
+        if value.startswith('[') and value.endswith(']'):
+            fields[key] = [_scalar(v) for v in value[1:-1].split(',') if v.strip()]
+        else:
+            fields[key] = _scalar(value)
+    return fields, text[match.end():]
+
+
+def _parse_tags(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    tags = []
+    for tag in value or ():
+        tag = str(tag).strip().lstrip('#').strip()
+        if tag:
+            tags.append(tag)
+    return tags
+
+
+def _parse_dt(value, default):
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.strip())
+        except ValueError:
+            pass
+    return default
+
+
+def _resolve_links(text, local_ids):
+    # Ссылки на импортируемые файлы заменяются ссылками на заметки [текст](local_id);
+    # ссылки на отсутствующие файлы остаются как есть
+    def wiki_link(match):
+        local_id = local_ids.get(_name_key(match.group(1)))
+        if local_id is None:
+            return match.group(0)
+        return f'[{(match.group(2) or match.group(1)).strip()}]({local_id})'
+
+    def file_link(match):
+        local_id = local_ids.get(_name_key(unquote(match.group(2))))
+        if local_id is None:
+            return match.group(0)
+        return f'[{match.group(1)}]({local_id})'
+
+    text = _WIKI_LINK_RE.sub(wiki_link, text)
+    return _FILE_LINK_RE.sub(file_link, text)
+
+
+def _read_note(entry, local_ids):
+    """Возвращает (заголовок, текст, теги, дата создания) или строку с причиной пропуска файла."""
+    if entry.size > MAX_FILE_SIZE:
+        return f'файл больше {MAX_FILE_SIZE // 1024} КБ'
+    try:
+        text = entry.read().decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return 'файл не в кодировке UTF-8'
+
+    fields, text = parse_front_matter(text)
+    text = _resolve_links(text, local_ids)
+    if len(text) > MAX_TEXT_LENGTH:
+        return f'текст длиннее {MAX_TEXT_LENGTH} символов'
+
+    title = fields.get('title')
+    if not isinstance(title, str) or not title.strip():
+        title = entry.name.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+    tags = _parse_tags(fields.get('tags', fields.get('tag')))
+    for tag in tags:
+        if len(tag) > MAX_TAG_LENGTH:
+            return f'тег длиннее {MAX_TAG_LENGTH} символов: {tag[:MAX_TAG_LENGTH]}...'
+    dt_added = _parse_dt(fields.get('created', fields.get('date')), entry.mtime)
+    return title.strip()[:MAX_TITLE_LENGTH], text, set(tags), dt_added
+
+
+def _load_batch(cursor, user_id, batch):
+    # batch: [(local_id, заголовок, текст, теги, дата создания)]
+    copy_rows(cursor, 'notes', ('user_id', 'local_id', 'title', 'text', 'html', 'html_version', 'dt_added'),
+              [(user_id, local_id, title, text, render_markdown(text), RENDER_VERSION, dt_added)
+               for local_id, title, text, tags, dt_added in batch])
+
+    query = r"select local_id, id from notes " \
+            r"where user_id = %s and local_id between %s and %s;"
+    cursor.execute(query, (user_id, batch[0][0], batch[-1][0]))
+    note_ids = dict(cursor.fetchall())
+
+    tags_str = sorted({tag for item in batch for tag in item[3]})
+    if len(tags_str) > 0:
+        # Все теги порции создаются одним запросом, как в Tag.add_tags
+        query = r"insert into user_tags (user_id, tag) " \
+                r"select %s, unnest(%s::varchar[]) " \
+                r"on conflict (user_id, tag) do update set tag = excluded.tag " \
+                r"returning id, tag;"
+        cursor.execute(query, (user_id, tags_str))
+        tag_ids = {tag: tag_id for tag_id, tag in cursor.fetchall()}
+        copy_rows(cursor, 'note_tags', ('tag_id', 'note_id'),
+                  [(tag_ids[tag], note_ids[local_id]) for local_id, _, _, tags, _ in batch for tag in sorted(tags)])
+
+    copy_rows(cursor, 'note_links', ('source_id', 'user_id', 'target_local_id'),
+              [(note_ids[local_id], user_id, target)
+               for local_id, _, text, _, _ in batch for target in sorted(extract_links(text))])
+
+
+def _import_entries(user_id, entries, progress):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    errors = []
+    imported = 0
+    try:
+        # local_id всех файлов выделяются из счётчика пользователя одним блоком
+        first_local_id = User.allocate_note_local_ids(user_id, len(entries), (conn, cursor))
+
+        # local_id назначаются до чтения файлов, чтобы ссылки на ещё не прочитанные
+        # файлы тоже разрешались. У пропущенных файлов local_id остаются незанятыми
+        local_ids = {}
+        for i, entry in enumerate(entries):
+            local_ids.setdefault(_name_key(entry.name), first_local_id + i)
+
+        batch = []
+        for i, entry in enumerate(entries):
+            note = _read_note(entry, local_ids)
+            if isinstance(note, str):
+                errors.append((entry.name, note))
+            else:
+                batch.append((first_local_id + i,) + note)
+            if len(batch) == BATCH_SIZE or (i == len(entries) - 1 and batch):
+                _load_batch(cursor, user_id, batch)
+                imported += len(batch)
+                batch = []
+            if progress is not None and ((i + 1) % BATCH_SIZE == 0 or i == len(entries) - 1):
+                progress(i + 1, len(entries))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        put_db_connection(conn)
+
+    return ImportResult(imported, errors)
+
+
+def import_vault(user_id, source, progress=None):
+    """Импортирует заметки из каталога или zip-архива с markdown-файлами.
+
+    source - путь к каталогу, путь к zip-архиву или открытый файл архива. Файлы читаются
+    по одному и загружаются порциями по BATCH_SIZE через COPY в одной транзакции;
+    progress(обработано файлов, всего файлов) вызывается после каждой порции.
+    """
+    if isinstance(source, str) and os.path.isdir(source):
+        return _import_entries(user_id, list(_dir_entries(source)), progress)
+    with zipfile.ZipFile(source) as archive:
+        return _import_entries(user_id, list(_zip_entries(archive)), progress)
+
+
+def _filename(local_id, title):
+    title = _FILENAME_UNSAFE_RE.sub(' ', title or '').strip()[:FILENAME_TITLE_LENGTH].strip()
+    return f'{local_id} {title}.md' if title else f'{local_id}.md'
+
+
+def _note_file(title, text, tags, dt_added, filenames):
+    # Ссылки [текст](local_id) заменяются ссылками на файлы: их понимают редакторы
+    # markdown, а import_vault превращает обратно в ссылки на заметки
+    def file_link(match):
+        filename = filenames.get(int(match.group(1)))
+        if filename is None:
+            return match.group(0)
+        return match.group(0)[:match.start(1) - match.start(0)] + filename.replace(' ', '%20') + ')'
+
+    lines = ['---', 'title: ' + json.dumps(title or '', ensure_ascii=False)]
+    if tags:
+        lines.append('tags:')
+        lines.extend('  - ' + json.dumps(tag, ensure_ascii=False) for tag in tags)
+    lines.append('created: ' + dt_added.isoformat())
+    lines.append('---')
+    return '\n'.join(lines) + '\n' + NOTE_LINK_RE.sub(file_link, text or '')
+
+
+class _ZipStream(io.RawIOBase):
+    # Поток без seek: zipfile пишет в него архив, а генератор забирает записанное
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def export_vault(user_id):
+    """Генератор zip-архива со всеми заметками пользователя, отдаёт его частями.
+
+    Заметки читаются с сервера именованным курсором порциями по BATCH_SIZE, поэтому
+    в памяти остаются только имена файлов заметок и ещё не отданная часть архива.
+    """
+    conn = get_db_connection(read_only=True)
+    cursor = conn.cursor()
+    read_cursor = None
+    try:
+        # Имена файлов и заметки читаются разными запросами: в одном снимке данных
+        # заметка, созданная между ними, не останется без имени файла
+        conn.rollback()
+        cursor.execute(r"set transaction isolation level repeatable read, read only;")
+        cursor.execute(r"select local_id, title from notes where user_id = %s;", (user_id,))
+        filenames = {local_id: _filename(local_id, title) for local_id, title in cursor.fetchall()}
+
+        read_cursor = conn.cursor(name='export_vault')
+        read_cursor.itersize = BATCH_SIZE
+        query = r"select local_id, title, text, dt_added, dt_edited, " \
+                r"array(select tag from note_tags " \
+                r"join user_tags on user_tags.id = note_tags.tag_id " \
+                r"where note_tags.note_id = notes.id order by tag) " \
+                r"from notes " \
+                r"where user_id = %s " \
+                r"order by local_id;"
+        read_cursor.execute(query, (user_id,))
+
+        stream = _ZipStream()
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for local_id, title, text, dt_added, dt_edited, tags in read_cursor:
+                dt = min(max(dt_edited or dt_added, ZIP_MIN_DATE), ZIP_MAX_DATE)
+                info = zipfile.ZipInfo(filenames[local_id], dt.timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, _note_file(title, text, tags, dt_added, filenames))
+                yield stream.pop()
+        yield stream.pop()
+    finally:
+        if read_cursor is not None:
+            read_cursor.close()
+        cursor.close()
+        # Транзакция только читала: завершаем её, чтобы соединение не осталось в ней
+        conn.rollback()
+        put_db_connection(conn)